@@ -0,0 +1,113 @@
+"""
+本機假 Gemini 伺服器，用來測試批次 AI 分析 (同時請求數、速率限制、重試)，不花真的額度。
+
+    python fake_gemini_server.py --port 8765 --latency 2.0 --error-rate 0.2
+    GEMINI_API_ENDPOINT=http://localhost:8765 python wardrobe_app.py
+
+每個 generateContent 請求等待 latency 秒後回傳固定的單品分析 JSON；
+多圖請求 (每張圖前有「檔名: xxx」文字) 則回傳含 filename 的 JSON Array。
+error-rate 的比例會隨機回 429 或 503，用來驗證退避重試。
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAKE_ITEM = {
+    "data": {
+        "type": "T恤",
+        "color": "白色",
+        "styleTags": ["休閒", "簡約"],
+        "seasons": ["春", "夏"],
+        "occasions": ["日常"],
+        "lengthDesc": "一般長度",
+        "bodyEffect": "修飾上半身",
+        "notes": "搭配牛仔褲即可"
+    }
+}
+
+class Stats:
+    lock = threading.Lock()
+    requests = 0
+    errors = 0
+    in_flight = 0
+    max_in_flight = 0
+
+def fake_answer(body):
+    # 多圖請求: 依「檔名: xxx」標籤逐一回傳
+    texts = [part.get('text', '') for content in body.get('contents', []) for part in content.get('parts', [])]
+    filenames = [t.split(':', 1)[1].strip() for t in texts if t.startswith('檔名:')]
+    if filenames:
+        return [{"filename": name, "data": FAKE_ITEM["data"]} for name in filenames]
+    return FAKE_ITEM
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    latency = 1.0
+    error_rate = 0.0
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            body = {}
+        if ':generateContent' not in self.path:
+            self._send(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+            return
+
+        with Stats.lock:
+            Stats.requests += 1
+            Stats.in_flight += 1
+            Stats.max_in_flight = max(Stats.max_in_flight, Stats.in_flight)
+        try:
+            time.sleep(self.latency)
+            if random.random() < self.error_rate:
+                code = random.choice([429, 503])
+                with Stats.lock:
+                    Stats.errors += 1
+                self._send(code, {"error": {"code": code, "message": "Injected failure",
+                                            "status": "RESOURCE_EXHAUSTED" if code == 429 else "UNAVAILABLE"}})
+                return
+            self._send(200, {
+                "candidates": [{
+                    "content": {"parts": [{"text": json.dumps(fake_answer(body), ensure_ascii=False)}], "role": "model"},
+                    "finishReason": "STOP",
+                    "index": 0
+                }]
+            })
+        finally:
+            with Stats.lock:
+                Stats.in_flight -= 1
+
+    def _send(self, code, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        print(f"{self.command} {self.path} -> {args[1] if len(args) > 1 else ''} "
+              f"(requests {Stats.requests}, errors {Stats.errors}, max in flight {Stats.max_in_flight})")
+
+def main():
+    parser = argparse.ArgumentParser(description='Local fake Gemini endpoint')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=1.0, help='seconds per request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 429/503')
+    args = parser.parse_args()
+
+    FakeGeminiHandler.latency = args.latency
+    FakeGeminiHandler.error_rate = args.error_rate
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), FakeGeminiHandler)
+    print(f"Fake Gemini listening on http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
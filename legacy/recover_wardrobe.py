@@ -3,8 +3,35 @@ import json
 import re
 import datetime
 
+try:
+    from PIL import Image
+    HAS_PIL = True
+except ImportError:
+    HAS_PIL = False
+
 WARDROBE_FILE = 'wardrobe.json'
 IMAGE_DIR = 'images'
+MAX_HASH_DISTANCE = 6 # dHash bits that may differ for two photos to count as the same garment
+
+def image_dhash(path):
+    # 64-bit difference hash; transparent cutouts are flattened onto white first
+    if not HAS_PIL:
+        return None
+    try:
+        img = Image.open(path)
+        img.draft('RGB', (64, 64))
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            img = Image.alpha_composite(Image.new('RGBA', img.size, (255, 255, 255, 255)), img)
+        pixels = list(img.convert('L').resize((9, 8), Image.BILINEAR).getdata())
+    except Exception as e:
+        print(f"Could not hash {path}: {e}")
+        return None
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
 
 def recover_data():
     if not os.path.exists(IMAGE_DIR):
@@ -12,6 +39,8 @@ def recover_data():
         return
 
     recovered_items = []
+    seen_hashes = [] # (hash, filename) of photos already recovered
+    skipped_duplicates = 0
     
     # Regex to parse filename: Name_Date_Index.ext
     # Example: 寬版長褲_20251203_001.png
@@ -19,13 +48,23 @@ def recover_data():
     
     print(f"Scanning {IMAGE_DIR}...")
     
-    for filename in os.listdir(IMAGE_DIR):
+    for filename in sorted(os.listdir(IMAGE_DIR)):
         if not filename.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
             continue
             
         if filename == 'user_body.png':
             continue
 
+        # Skip photos that are near-duplicates of one we already recovered
+        photo_hash = image_dhash(os.path.join(IMAGE_DIR, filename))
+        if photo_hash is not None:
+            match = next((name for h, name in seen_hashes if bin(photo_hash ^ h).count('1') <= MAX_HASH_DISTANCE), None)
+            if match:
+                print(f"Skipped near-duplicate: {filename} (same photo as {match})")
+                skipped_duplicates += 1
+                continue
+            seen_hashes.append((photo_hash, filename))
+
         name_part = os.path.splitext(filename)[0]
         
         # Try to extract ID parts
@@ -69,6 +108,8 @@ def recover_data():
         print(f"Recovered: {item_name} (ID: {item_id})")
 
     print(f"Total items recovered: {len(recovered_items)}")
+    if skipped_duplicates:
+        print(f"Near-duplicate photos skipped: {skipped_duplicates}")
     
     if recovered_items:
         # Backup existing if it has content (unlikely based on previous check, but good practice)
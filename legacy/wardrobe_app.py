@@ -1,17 +1,64 @@
+import time
+_PROCESS_START = time.perf_counter() # 用於量測啟動時間 (--startup-time)
+
 import FreeSimpleGUI as sg
+import sys
 import json
 import os
+import copy
+import contextlib
+import threading
 import datetime
 import re
 import io
 import urllib.request
-from typing import Optional, Dict, List, Any, Union
+import importlib
+import importlib.util
+from typing import Optional, Dict, List, Any, Union, Iterator, Tuple
+
+# =============================================================================
+# 延遲載入 (Lazy Import)
+# =============================================================================
+# rembg (會連帶載入 onnxruntime / numpy)、PIL、google.generativeai 都很重，
+# 啟動時只檢查是否有安裝，真正用到時 (或背景預熱時) 才 import。
+
+_LAZY_MODULES = {}
+IMPORT_TIMINGS = {} # module name -> import 秒數
+
+def has_module(name: str) -> bool:
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+def lazy_import(name: str):
+    """
+    第一次呼叫時 import 模組並快取，之後直接回傳快取。
+    """
+    mod = _LAZY_MODULES.get(name)
+    if mod is None:
+        start = time.perf_counter()
+        mod = importlib.import_module(name)
+        IMPORT_TIMINGS.setdefault(name, time.perf_counter() - start)
+        _LAZY_MODULES[name] = mod
+    return mod
+
+def warm_up_imports(names: List[str]):
+    """
+    在背景執行緒預先載入模組，讓使用者第一次點擊時不必等待。
+    """
+    def _worker():
+        for name in names:
+            try:
+                lazy_import(name)
+            except Exception as e:
+                print(f"Warm-up import {name} failed: {e}")
+    t = threading.Thread(target=_worker, daemon=True)
+    t.start()
+    return t
 
-try:
-    from PIL import Image
-    HAS_PIL = True
-except ImportError:
-    HAS_PIL = False
+HAS_PIL = has_module('PIL')
+WARM_UP_IMPORTS = True # 視窗出現後在背景預先載入 PIL 與預設去背模型
 
 # =============================================================================
 # 設定與常數
@@ -19,8 +66,64 @@ except ImportError:
 
 PROFILE_FILE = 'user_profile.json'
 WARDROBE_FILE = 'wardrobe.json'
-OOTD_LOG_FILE = 'ootd_log.json'
+OOTD_LOG_FILE = 'ootd_log.jsonl'
+LEGACY_OOTD_LOG_FILE = 'ootd_log.json' # 舊版格式，首次啟動時自動轉換
+CALENDAR_PAGE_SIZE = 100 # 穿搭日曆一次顯示的筆數
+DUPLICATE_LOG_WINDOW_MINUTES = 30 # 這段時間內記錄相同穿搭視為重複
+DUPLICATE_LOG_SCAN = 20 # 檢查重複時往回看的筆數
+CURRENCY_CACHE_FILE = 'currency_rates.json'
+CURRENCY_CACHE_TTL_HOURS = 12 # 匯率快取有效時間
 IMAGE_DIR = 'images'
+THUMB_CACHE_DIR = 'thumb_cache' # 縮圖快取資料夾
+THUMB_CACHE_MAX_BYTES = 200 * 1024 * 1024 # 縮圖快取上限 (超過時刪除最久沒用的)
+THUMBNAIL_SIZES = [(200, 200), (300, 300), (800, 800)] # 卡片 / 預覽 / 放大
+REMBG_WORKERS = max(1, (os.cpu_count() or 2) // 2) # 批次去背的 process 數 (每個 process 各載入一份模型)
+REMBG_MAX_RESIDENT_BYTES = 400 * 1024 * 1024 # 去背模型常駐記憶體上限 (以載入時的 RSS 增量計，超過時卸載最久沒用的)
+FILE_HASH_INDEX_FILE = 'file_hashes.jsonl' # 圖片 (路徑, mtime, 大小) -> 內容 SHA-1，去背與 AI 快取共用
+REMBG_CACHE_DIR = 'rembg_cache' # 去背結果快取 (依原圖內容與參數)
+REMBG_CACHE_MAX_BYTES = 300 * 1024 * 1024 # 去背結果快取上限 (超過時刪除最久沒用的)
+REMBG_FAST_MODE = False # 在縮小尺寸上推論再放大遮罩；先用 --benchmark-rembg 確認品質再開啟
+REMBG_FAST_MAX_SIDE = 1024 # 快速模式推論用的最長邊
+PHASH_INDEX_FILE = 'phash_index.json' # 圖片感知雜湊索引 (找近似重複的照片)
+PHASH_MAX_DISTANCE = 6 # 64 bit dHash 相差幾個 bit 以內視為同一張照片
+IMPORT_DUPLICATE_POLICY = 'skip' # 批次匯入遇到近似重複: 'skip' 略過 / 'flag' 照常匯入但在備註標示 / 'off'
+GEMINI_MODEL = 'gemini-1.5-flash-latest'
+GEMINI_API_ENDPOINT = os.environ.get('GEMINI_API_ENDPOINT') # 例: http://localhost:8765 (本機假伺服器)
+AI_MAX_IN_FLIGHT = 4 # 批次分析同時進行的請求數
+AI_REQUESTS_PER_MINUTE = 60 # 批次分析的速率上限
+AI_MAX_RETRIES = 4 # 429 / 5xx 時的重試次數
+AI_BACKOFF_SECONDS = 1.0 # 第一次重試前的等待時間 (之後每次加倍)
+GEMINI_REQUEST_TIMEOUT = 60 # 單次 Gemini 請求逾時秒數 (SDK 內建重試關閉，只由 call_ai_with_retry 重試)
+AI_BATCH_MAX_IMAGES = 8 # 批次匯入時一個請求最多放幾張圖 (1 = 每張各自呼叫)
+AI_BATCH_TOKEN_BUDGET = 16000 # 一個多圖請求的預估 token 上限 (含輸出)
+GEMINI_IMAGE_TOKENS = 258 # Gemini 每張圖片計費的 token 數
+AI_BATCH_OUTPUT_TOKENS_PER_ITEM = 300 # 每件單品預估的回應長度
+OOTD_PREFILTER_TOP_K = 8 # OOTD prompt 每個分類最多放幾件候選單品
+OOTD_PROMPT_TOKEN_BUDGET = 6000 # OOTD prompt 的預估 token 上限 (超過時再降低每類件數)
+OOTD_LOCAL_TOP_N = 3 # 本機推薦回傳幾套
+OOTD_LOCAL_POOL_SIZE = 6 # 本機推薦每個分類取幾件候選來組合
+OOTD_SHORTLIST_IN_PROMPT = True # OOTD prompt 附上本機推薦的候選搭配
+GEMINI_GENERATION_CONFIG = {'response_mime_type': 'application/json'}
+GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY') # 有設定時不必每次輸入
+GEMINI_TIMING_HISTORY = 200 # 每個 GeminiClient 保留的耗時紀錄筆數
+AI_CACHE_ENABLED = True # AI 回應快取 (相同模型 + prompt + 圖片 + 設定直接重用)
+AI_CACHE_DIR = 'ai_cache'
+AI_CACHE_TTL_HOURS = 24 * 30
+AI_CACHE_MAX_BYTES = 50 * 1024 * 1024
+EXPORT_IMAGE_SIZE = (1024, 1024) # OOTD 匯出勾選「縮小圖片」時的最大尺寸
+EXPORT_RESIZE_DEFAULT = False # 匯出預設放原圖
+EXPORT_JPEG_QUALITY = 88
+IMAGE_MAX_SIDE = 1000 # 存入衣櫃的圖片最長邊 (與網頁版 src/utils.js 相同的 1000px 上限)
+IMAGE_WEBP_QUALITY = 80
+KEEP_ORIGINAL_IMAGES = False # True 時另存一份原圖到 images/originals/
+ORIGINALS_DIR = os.path.join(IMAGE_DIR, 'originals')
+
+# 衣櫃儲存引擎:
+#   'journal' - wardrobe.json + 追加式異動日誌 (預設)
+#   'json'    - 每次異動整份重寫 wardrobe.json
+#   'sqlite'  - wardrobe.db，單筆寫入
+WARDROBE_STORAGE = 'journal'
+JOURNAL_COMPACT_BYTES = 256 * 1024 # 日誌超過此大小才壓縮回 wardrobe.json
 
 # Ensure image directory exists
 if not os.path.exists(IMAGE_DIR):
@@ -53,28 +156,405 @@ def card_frame(title, layout, font=FONT_HEADER):
                    background_color='#1E1E1E', pad=((0,0), (10, 10)), 
                    border_width=0, element_justification='left', expand_x=True)
 
-# Try importing rembg
-HAS_REMBG = False
-try:
-    from rembg import remove, new_session
-    HAS_REMBG = True
-except ImportError:
-    pass
+class DiskCacheDir:
+    """
+    磁碟快取資料夾的大小上限 (縮圖、去背結果、AI 回應共用)。
+    - 只計算副檔名為 suffix 的快取檔，總大小第一次寫入時才掃描，之後累加
+    - 覆寫既有檔案時扣掉舊檔大小，總數不會越算越大
+    - 超過上限時依 mtime 由舊到新刪除，直到低於上限的 90% (命中時呼叫 touch 標記為最近使用)
+    """
+    def __init__(self, cache_dir: str, max_bytes: int, suffix: str):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self._lock = threading.Lock()
+        self._total = None # 第一次寫入時才掃描目錄
+
+    def write(self, path: str, data: bytes):
+        """以暫存檔 + os.replace 寫入 path，並更新總大小。OSError 交給呼叫端處理。"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        with self._lock:
+            try:
+                old_size = os.path.getsize(path)
+            except OSError:
+                old_size = 0
+            os.replace(temp_path, path)
+            if self._total is None:
+                self._total = self._scan_total()
+            else:
+                self._total += len(data) - old_size
+            if self._total > self.max_bytes:
+                self._evict()
+
+    @staticmethod
+    def touch(path: str):
+        with contextlib.suppress(OSError):
+            os.utime(path, None) # 標記為最近使用
+
+    def remove(self, path: str):
+        with self._lock:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                return
+            if self._total is not None:
+                self._total -= size
+
+    def _scan_total(self) -> int:
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(self.suffix):
+                total += entry.stat().st_size
+        return total
+
+    def _evict(self):
+        # 依 mtime 由舊到新刪除，直到低於上限的 90%
+        entries = [e for e in os.scandir(self.cache_dir) if e.name.endswith(self.suffix)]
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        total = sum(e.stat().st_size for e in entries)
+        target = self.max_bytes * 0.9
+        for e in entries:
+            if total <= target:
+                break
+            try:
+                size = e.stat().st_size
+                os.remove(e.path)
+                total -= size
+            except OSError:
+                pass
+        self._total = total
+
+# rembg 只檢查是否安裝，第一次去背時才載入
+HAS_REMBG = has_module('rembg')
+
+class RembgSessionManager:
+    """
+    管理 rembg 模型 session:
+    - 可在背景預先載入預設模型，第一次去背不用等待
+    - 所有已載入模型的記憶體超過上限時，卸載最久沒用的模型 (LRU)
+    - 記錄每個模型的載入時間與記憶體用量: 以載入前後的 process RSS 差值量測，
+      無法取得 RSS 時才退回用 .onnx 檔案大小估計 (報表會標示來源)
+    """
+    def __init__(self, max_bytes: int):
+        from collections import OrderedDict
+        self.max_bytes = max_bytes
+        self._sessions = OrderedDict() # model name -> session (最近使用的在最後)
+        self._lock = threading.Lock()
+        self.stats = {} # model name -> {'load_seconds': float, 'bytes': int, 'source': 'rss' | 'file'}
+
+    @staticmethod
+    def _process_rss() -> Optional[int]:
+        if has_module('psutil'):
+            return lazy_import('psutil').Process().memory_info().rss
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError, AttributeError):
+            return None
+
+    @staticmethod
+    def _estimate_bytes(model_name: str) -> int:
+        # 量不到 RSS 時的後備: 以 ~/.u2net 內的 .onnx 檔案大小估計
+        model_home = os.environ.get('U2NET_HOME', os.path.join(os.path.expanduser('~'), '.u2net'))
+        try:
+            return os.path.getsize(os.path.join(model_home, f"{model_name}.onnx"))
+        except OSError:
+            return 0
 
-# Cache for rembg sessions
-REMBG_SESSIONS = {}
+    def get(self, model_name: str):
+        with self._lock:
+            if model_name in self._sessions:
+                self._sessions.move_to_end(model_name)
+                return self._sessions[model_name]
+
+            print(f"Loading rembg model: {model_name}...")
+            rembg = lazy_import('rembg') # 模組本身的記憶體不算在模型上
+            rss_before = self._process_rss()
+            start = time.perf_counter()
+            session = rembg.new_session(model_name)
+            load_seconds = time.perf_counter() - start
+            rss_after = self._process_rss()
+            if rss_before is not None and rss_after is not None and rss_after > rss_before:
+                size, source = rss_after - rss_before, 'rss'
+            else:
+                size, source = self._estimate_bytes(model_name), 'file'
+            self.stats[model_name] = {'load_seconds': load_seconds, 'bytes': size, 'source': source}
+            print(f"Loaded rembg model {model_name} in {load_seconds:.2f}s "
+                  f"(~{size / 1024 / 1024:.0f} MB, {'RSS delta' if source == 'rss' else 'file size estimate'})")
+            self._sessions[model_name] = session
+            self._evict()
+            return session
+
+    def _evict(self):
+        # 至少保留剛載入的那一個
+        while len(self._sessions) > 1 and self.resident_bytes() > self.max_bytes:
+            name, _ = self._sessions.popitem(last=False)
+            print(f"Unloading rembg model: {name}")
+
+    def resident_bytes(self) -> int:
+        return sum(self.stats.get(name, {}).get('bytes', 0) for name in self._sessions)
+
+    def loaded_models(self) -> List[str]:
+        return list(self._sessions)
+
+    def preload(self, model_name: str):
+        """
+        在背景執行緒載入模型。
+        """
+        def _worker():
+            try:
+                self.get(model_name)
+            except Exception as e:
+                print(f"Error preloading model {model_name}: {e}")
+        t = threading.Thread(target=_worker, daemon=True)
+        t.start()
+        return t
+
+    def report(self) -> str:
+        lines = []
+        for name, st in self.stats.items():
+            state = '常駐' if name in self._sessions else '已卸載'
+            source = 'RSS 增量' if st.get('source') == 'rss' else '檔案大小估計'
+            lines.append(f"{name}: 載入 {st['load_seconds']:.2f}s, ~{st['bytes'] / 1024 / 1024:.0f} MB {source} ({state})")
+        return "\n".join(lines)
+
+REMBG_SESSION_MANAGER = RembgSessionManager(REMBG_MAX_RESIDENT_BYTES)
 
 def get_rembg_session(model_name):
     if not HAS_REMBG:
         return None
-    if model_name not in REMBG_SESSIONS:
+    try:
+        return REMBG_SESSION_MANAGER.get(model_name)
+    except Exception as e:
+        print(f"Error loading model {model_name}: {e}")
+        return None
+
+class FileHashIndex:
+    """
+    (路徑, mtime, 大小) -> 檔案內容 SHA-1 的索引，同一個檔案不必重複雜湊。
+    索引檔是追加式的 JSON Lines: 每算出一個新雜湊只在尾端追加一行，
+    不會每張圖整份重寫；多個 worker process 同時追加也不會互相覆蓋。
+    """
+    def __init__(self, log_path: str):
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        self._index = None
+
+    def _load(self) -> Dict[str, str]:
+        if self._index is None:
+            self._index = {}
+            try:
+                with open(self.log_path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                            self._index[entry['key']] = entry['sha1']
+                        except (ValueError, KeyError, TypeError):
+                            continue # 寫到一半的行直接略過
+            except OSError:
+                pass
+        return self._index
+
+    def content_hash(self, path: str, data: Optional[bytes] = None) -> Optional[str]:
+        import hashlib
         try:
-            print(f"Loading rembg model: {model_name}...")
-            REMBG_SESSIONS[model_name] = new_session(model_name)
-        except Exception as e:
-            print(f"Error loading model {model_name}: {e}")
+            st = os.stat(path)
+        except OSError:
             return None
-    return REMBG_SESSIONS.get(model_name)
+        file_key = f"{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}"
+        with self._lock:
+            digest = self._load().get(file_key)
+        if digest:
+            return digest
+        if data is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        line = json.dumps({'key': file_key, 'sha1': digest}, ensure_ascii=False) + '\n'
+        with self._lock:
+            self._load()[file_key] = digest
+            try:
+                os.makedirs(os.path.dirname(self.log_path) or '.', exist_ok=True)
+                with open(self.log_path, 'a', encoding='utf-8') as f:
+                    f.write(line)
+            except OSError as e:
+                print(f"Hash index write error: {e}")
+        return digest
+
+FILE_HASH_INDEX = FileHashIndex(FILE_HASH_INDEX_FILE)
+
+class RembgResultCache:
+    """
+    去背結果快取。key = (原圖內容雜湊, 模型, alpha matting 參數)，
+    相同圖片用相同設定去背時直接回傳上次的結果。
+    原圖內容雜湊記在共用的 FileHashIndex，不必每次都重新雜湊原圖。
+    總大小超過上限時，刪除最久沒用到的結果 (見 DiskCacheDir)。
+    """
+    def __init__(self, cache_dir: str, max_bytes: int, hashes: FileHashIndex):
+        self.cache_dir = cache_dir
+        self.hashes = hashes
+        self.disk = DiskCacheDir(cache_dir, max_bytes, '.png')
+
+    def content_hash(self, img_path: str, data: Optional[bytes] = None) -> Optional[str]:
+        return self.hashes.content_hash(img_path, data)
+
+    @staticmethod
+    def _result_name(digest: str, model_name: str, alpha_matting: bool, fg: int, bg: int, erode: int) -> str:
+        # 沒開 alpha matting 時閾值不影響結果，不列入 key
+        params = f"a{fg}-{bg}-{erode}" if alpha_matting else "plain"
+        return f"{digest}_{model_name}_{params}.png"
+
+    def get(self, img_path: str, model_name: str, alpha_matting: bool, fg: int, bg: int, erode: int) -> Optional[bytes]:
+        digest = self.content_hash(img_path)
+        if not digest:
+            return None
+        path = os.path.join(self.cache_dir, self._result_name(digest, model_name, alpha_matting, fg, bg, erode))
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        self.disk.touch(path)
+        return data
+
+    def put(self, img_path: str, model_name: str, alpha_matting: bool, fg: int, bg: int, erode: int,
+            output_data: bytes, input_data: Optional[bytes] = None):
+        digest = self.content_hash(img_path, input_data)
+        if not digest:
+            return
+        path = os.path.join(self.cache_dir, self._result_name(digest, model_name, alpha_matting, fg, bg, erode))
+        try:
+            self.disk.write(path, output_data)
+        except OSError as e:
+            print(f"Rembg cache write error: {e}")
+
+REMBG_RESULT_CACHE = RembgResultCache(REMBG_CACHE_DIR, REMBG_CACHE_MAX_BYTES, FILE_HASH_INDEX)
+
+def _rembg_standard(input_data: bytes, session, alpha_matting: bool = False,
+                    fg: int = 240, bg: int = 10, erode: int = 10) -> bytes:
+    # 原本的做法: 整張原圖交給 rembg 解碼與處理
+    return lazy_import('rembg').remove(input_data, session=session,
+                                       alpha_matting=alpha_matting,
+                                       alpha_matting_foreground_threshold=fg,
+                                       alpha_matting_background_threshold=bg,
+                                       alpha_matting_erode_size=erode)
+
+def _rembg_fast(img_path: str, session, max_side: int = None) -> bytes:
+    """
+    快速模式: 以縮小尺寸解碼 (JPEG 用 draft 直接在解碼時縮小) 後推論出遮罩，
+    再把遮罩放大套回原圖的 alpha。分割模型本身只在 320~1024px 上運算，
+    12MP 照片整張送進去只是白白多花解碼與前後處理的時間。
+    """
+    Image = lazy_import('PIL.Image')
+    ImageOps = lazy_import('PIL.ImageOps')
+    max_side = max_side or REMBG_FAST_MAX_SIDE
+
+    small = Image.open(img_path)
+    small.draft('RGB', (max_side, max_side))
+    small = ImageOps.exif_transpose(small).convert('RGB')
+    small.thumbnail((max_side, max_side))
+    mask = lazy_import('rembg').remove(small, session=session, only_mask=True)
+
+    original = ImageOps.exif_transpose(Image.open(img_path)).convert('RGBA')
+    mask = mask.convert('L').resize(original.size, Image.BILINEAR)
+    # 與 rembg 的 naive_cutout 相同: 和全透明黑底合成，alpha 為 0 的像素 RGB 也歸零
+    cutout = Image.composite(original, Image.new('RGBA', original.size, 0), mask)
+
+    bio = io.BytesIO()
+    cutout.save(bio, format="PNG")
+    return bio.getvalue()
+
+def remove_background_bytes(img_path: str, model_name: str = 'u2net', alpha_matting: bool = False,
+                            fg: int = 240, bg: int = 10, erode: int = 10, fast: bool = None) -> Optional[bytes]:
+    """
+    去背並回傳 PNG bytes；命中快取時不載入模型、不做推論。
+    fast=True 時在縮小尺寸上推論再放大遮罩 (alpha matting 需要原尺寸，開啟時不走快速模式)。
+    模型無法載入時回傳 None，其他錯誤直接拋出。
+    """
+    fast = (REMBG_FAST_MODE if fast is None else fast) and HAS_PIL and not alpha_matting
+    cache_model = f"{model_name}-fast" if fast else model_name
+    cached = REMBG_RESULT_CACHE.get(img_path, cache_model, alpha_matting, fg, bg, erode)
+    if cached:
+        return cached
+
+    session = get_rembg_session(model_name)
+    if not session:
+        return None
+    input_data = None
+    if fast:
+        output_data = _rembg_fast(img_path, session)
+    else:
+        with open(img_path, 'rb') as i:
+            input_data = i.read()
+        output_data = _rembg_standard(input_data, session, alpha_matting, fg, bg, erode)
+    REMBG_RESULT_CACHE.put(img_path, cache_model, alpha_matting, fg, bg, erode, output_data, input_data)
+    return output_data
+
+def _alpha_quality(reference: bytes, candidate: bytes) -> dict:
+    """比較兩張去背結果的 alpha: 整體 IoU 與邊緣帶 (參考遮罩邊界 ±3px) 的平均誤差 (0~255)。"""
+    Image = lazy_import('PIL.Image')
+    ImageChops = lazy_import('PIL.ImageChops')
+    ImageFilter = lazy_import('PIL.ImageFilter')
+    ImageStat = lazy_import('PIL.ImageStat')
+    ref = Image.open(io.BytesIO(reference)).getchannel('A')
+    cand = Image.open(io.BytesIO(candidate)).getchannel('A')
+    if cand.size != ref.size:
+        cand = cand.resize(ref.size, Image.BILINEAR)
+
+    ref_bin = ref.point(lambda v: 255 if v > 127 else 0)
+    cand_bin = cand.point(lambda v: 255 if v > 127 else 0)
+    inter = ImageChops.logical_and(ref_bin.convert('1'), cand_bin.convert('1')).histogram()[-1]
+    union = ImageChops.logical_or(ref_bin.convert('1'), cand_bin.convert('1')).histogram()[-1]
+
+    band = ref_bin.filter(ImageFilter.FIND_EDGES).filter(ImageFilter.MaxFilter(7))
+    band = band.point(lambda v: 255 if v else 0)
+    diff = ImageChops.difference(ref, cand)
+    edge_err = ImageStat.Stat(diff, mask=band).mean[0] if band.getbbox() else 0.0
+    return {'iou': inter / union if union else 1.0, 'edge_mae': edge_err}
+
+def benchmark_rembg(fixture_dir: str = IMAGE_DIR, model_name: str = 'u2net', limit: int = 20):
+    """
+    比較原本的去背流程與快速模式: 每張圖的耗時與邊緣品質。
+    直接呼叫兩條路徑 (不經結果快取)，模型先預載，避免把載入時間算進第一張。
+    """
+    if not (HAS_REMBG and HAS_PIL):
+        print("Benchmark requires rembg and Pillow.")
+        return []
+    session = get_rembg_session(model_name)
+    if not session:
+        print(f"Cannot load rembg model '{model_name}'.")
+        return []
+
+    files = sorted(f for f in os.listdir(fixture_dir)
+                   if f.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')) and '_nobg' not in f)[:limit]
+    rows = []
+    for fname in files:
+        path = os.path.join(fixture_dir, fname)
+        with open(path, 'rb') as f:
+            data = f.read()
+        t0 = time.perf_counter()
+        standard = _rembg_standard(data, session)
+        t1 = time.perf_counter()
+        fast = _rembg_fast(path, session)
+        t2 = time.perf_counter()
+        quality = _alpha_quality(standard, fast)
+        rows.append({'file': fname, 'standard_ms': (t1 - t0) * 1000, 'fast_ms': (t2 - t1) * 1000, **quality})
+        print(f"{fname:40s} standard {rows[-1]['standard_ms']:8.0f} ms  fast {rows[-1]['fast_ms']:8.0f} ms  "
+              f"IoU {quality['iou']:.4f}  edge MAE {quality['edge_mae']:.1f}")
+
+    if rows:
+        n = len(rows)
+        std_total = sum(r['standard_ms'] for r in rows)
+        fast_total = sum(r['fast_ms'] for r in rows)
+        print(f"{n} images: standard avg {std_total / n:.0f} ms, fast avg {fast_total / n:.0f} ms "
+              f"({std_total / max(fast_total, 1e-9):.1f}x), "
+              f"mean IoU {sum(r['iou'] for r in rows) / n:.4f}, "
+              f"mean edge MAE {sum(r['edge_mae'] for r in rows) / n:.1f}")
+    return rows
 
 def perform_background_removal_flow(img_path):
     """
@@ -89,28 +569,20 @@ def perform_background_removal_flow(img_path):
     alpha_fg = 240
     alpha_bg = 10
     
-    # 讀取原始圖片
-    try:
-        with open(img_path, 'rb') as i:
-            input_data = i.read()
-    except Exception as e:
-        sg.popup_error(f'讀取圖片失敗: {e}')
+    # 確認原始圖片可讀取
+    if not os.path.isfile(img_path):
+        sg.popup_error(f'讀取圖片失敗: {img_path}')
         return None
 
     while True:
         sg.popup_quick_message(f'正在使用 {current_model} 模型去背中...\n(Alpha: {use_alpha}, Erode: {alpha_erode})', background_color='#1E1E1E', text_color='#D4AF37', font=FONT_HEADER)
         
         try:
-            session = get_rembg_session(current_model)
-            if not session:
+            output_data = remove_background_bytes(img_path, current_model, use_alpha,
+                                                  alpha_fg, alpha_bg, alpha_erode)
+            if not output_data:
                 sg.popup_error(f'無法載入模型: {current_model}')
                 return None
-                
-            output_data = remove(input_data, session=session, 
-                               alpha_matting=use_alpha, 
-                               alpha_matting_foreground_threshold=alpha_fg, 
-                               alpha_matting_background_threshold=alpha_bg,
-                               alpha_matting_erode_size=alpha_erode)
             
             # 暫存去背結果
             dir_name = os.path.dirname(img_path)
@@ -127,6 +599,7 @@ def perform_background_removal_flow(img_path):
             preview_layout = [
                 [sg.Text(f'✨ 去背完成 (模型: {current_model})', font=FONT_HEADER, text_color='#D4AF37', background_color='#121212', justification='center')],
                 [sg.Text('如果不滿意，請嘗試切換其他模型或調整參數', font=FONT_SMALL, text_color='#9E9E9E', background_color='#121212', justification='center')],
+                [sg.Text(REMBG_SESSION_MANAGER.report(), font=FONT_SMALL, text_color='#757575', background_color='#121212')],
                 [sg.Column([
                     [sg.Text('原始圖片 (點擊放大)', font=FONT_NORMAL, text_color='white', background_color='#121212')],
                     [sg.Image(data=orig_bytes, background_color='#2C2C2C', key='-PREVIEW-ORIG-', enable_events=True, tooltip='點擊放大')]
@@ -213,14 +686,9 @@ def remove_bg_silent(img_path):
         return None
 
     try:
-        with open(img_path, 'rb') as i:
-            input_data = i.read()
-            
-        session = get_rembg_session('u2net')
-        if not session:
+        output_data = remove_background_bytes(img_path, 'u2net')
+        if not output_data:
             return None
-            
-        output_data = remove(input_data, session=session)
         
         dir_name = os.path.dirname(img_path)
         base_name = os.path.splitext(os.path.basename(img_path))[0]
@@ -234,55 +702,432 @@ def remove_bg_silent(img_path):
         print(f"Silent remove bg failed: {e}")
         return None
 
-def call_ai_api(prompt, image_path=None, api_key=None):
+def _rembg_pool_init(model_name):
+    # 每個 worker process 各自載入一份模型
+    get_rembg_session(model_name)
+
+def _rembg_pool_task(img_path):
+    return remove_bg_silent(img_path)
+
+def remove_bg_batch(img_paths: List[str], workers: int = None, progress_callback=None) -> List[Optional[str]]:
     """
-    呼叫 Google Gemini API 進行分析。
+    以多個 process 平行去背，回傳與 img_paths 順序相同的去背路徑 (失敗為 None)。
+    progress_callback(done, total, img_path) 每完成一張呼叫一次，回傳 False 可中止。
     """
-    if not api_key:
-        print("API Key is missing.")
-        return None
-
-    try:
-        import google.generativeai as genai
-        
-        genai.configure(api_key=api_key)
-        
-        # 使用 gemini-flash-latest 模型
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        
-        content = [prompt]
-        
-        if image_path:
-            if not HAS_PIL:
-                print("PIL not installed, cannot process image for Gemini.")
-                return None
-            
+    total = len(img_paths)
+    results = [None] * total
+    if not HAS_REMBG or total == 0:
+        return results
+
+    workers = min(workers or REMBG_WORKERS, total)
+    if workers <= 1:
+        for i, img_path in enumerate(img_paths):
+            results[i] = remove_bg_silent(img_path)
+            if progress_callback and progress_callback(i + 1, total, img_path) is False:
+                break
+        return results
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    # 用 spawn 而非 fork: fork 會複製背景預載執行緒持有中的 RembgSessionManager._lock，子行程會卡死
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_rembg_pool_init, initargs=('u2net',)) as pool:
+        futures = {pool.submit(_rembg_pool_task, img_path): i for i, img_path in enumerate(img_paths)}
+        done = 0
+        for future in as_completed(futures):
+            i = futures[future]
             try:
-                img = Image.open(image_path)
-                content.append(img)
+                results[i] = future.result()
             except Exception as e:
-                print(f"Error opening image for Gemini: {e}")
-                return None
+                print(f"Parallel remove bg failed for {img_paths[i]}: {e}")
+            done += 1
+            if progress_callback and progress_callback(done, total, img_paths[i]) is False:
+                for f in futures:
+                    f.cancel()
+                break
+    return results
 
-        # 設定 generation config 以確保回傳 JSON
-        generation_config = genai.types.GenerationConfig(
-            response_mime_type="application/json"
-        )
+def make_progress_callback(progress_window, label: str):
+    """
+    產生給 remove_bg_batch 等批次工作用的進度回呼，更新 -PROG-BAR- / -PROG-TXT-。
+    視窗被關閉時回傳 False 以中止。
+    """
+    def _callback(done, total, path):
+        if progress_window.was_closed():
+            return False
+        progress_window['-PROG-BAR-'].update(current_count=done, max=total)
+        progress_window['-PROG-TXT-'].update(f'{label} ({done}/{total}): {os.path.basename(path)}')
+        progress_window.refresh()
+        return True
+    return _callback
 
-        response = model.generate_content(
-            content,
-            generation_config=generation_config
-        )
-        
-        return response.text
-        
-    except ImportError:
-        print("google-generativeai module not found.")
-        return None
-    except Exception as e:
-        print(f"Gemini API Error: {e}")
+class AIRequestError(Exception):
+    """
+    AI API 呼叫失敗。status 為 HTTP 狀態碼 (未知時為 None)；
+    retryable 表示稍後重試可能成功 (429 流量限制、5xx 伺服器錯誤、連線問題)。
+    """
+    def __init__(self, message: str, status: Optional[int] = None, retryable: bool = False):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+
+def _gemini_configure_kwargs(api_key: str) -> Dict[str, Any]:
+    kwargs = {'api_key': api_key}
+    if GEMINI_API_ENDPOINT:
+        # 指向本機的假 Gemini 伺服器 (fake_gemini_server.py) 做測試
+        kwargs['transport'] = 'rest'
+        kwargs['client_options'] = {'api_endpoint': GEMINI_API_ENDPOINT}
+    return kwargs
+
+class GeminiClient:
+    """
+    長駐的 Gemini 用戶端 (每組 api_key + 模型一個)。
+    genai.configure() 會丟掉 SDK 內部已建立的連線，所以只在第一次 (或換 key 時) 呼叫；
+    GenerativeModel 也只建立一次。圖片直接以原始 bytes 上傳，不經 PIL 解碼再重新編碼。
+    每次呼叫記錄準備 (讀圖) 與請求耗時，可用 report() 查看。
+    """
+    _configure_lock = threading.Lock()
+    _configured_key = None
+
+    def __init__(self, api_key: str, model_name: str):
+        self.api_key = api_key
+        self.model_name = model_name
+        t0 = time.perf_counter()
+        self.genai = lazy_import('google.generativeai')
+        self._ensure_configured()
+        self.model = self.genai.GenerativeModel(model_name)
+        self.generation_config = self.genai.types.GenerationConfig(**GEMINI_GENERATION_CONFIG)
+        self.setup_ms = (time.perf_counter() - t0) * 1000
+        self._lock = threading.Lock()
+        self.timings = [] # (準備 ms, 請求 ms)，只保留最近 GEMINI_TIMING_HISTORY 筆
+
+    def _ensure_configured(self):
+        with GeminiClient._configure_lock:
+            if GeminiClient._configured_key != self.api_key:
+                self.genai.configure(**_gemini_configure_kwargs(self.api_key))
+                GeminiClient._configured_key = self.api_key
+
+    @staticmethod
+    def _image_part(image_path: str):
+        import mimetypes
+        mime = mimetypes.guess_type(image_path)[0]
+        if mime in ('image/png', 'image/jpeg', 'image/webp', 'image/heic', 'image/heif'):
+            with open(image_path, 'rb') as f:
+                return {'mime_type': mime, 'data': f.read()}
+        # 其他格式交給 PIL 轉換
+        if not HAS_PIL:
+            raise AIRequestError("PIL not installed, cannot process image for Gemini.")
+        return lazy_import('PIL.Image').open(image_path)
+
+    def generate(self, prompt: str, image_path: Optional[str] = None,
+                 images: Optional[List[Tuple[str, str]]] = None) -> str:
+        """
+        images: 多張圖片一次送出時使用，(標籤, 路徑) 清單；每張圖前面會加上標籤文字 (例如檔名)。
+        """
+        t0 = time.perf_counter()
+        content = [prompt]
+        try:
+            if image_path:
+                content.append(self._image_part(image_path))
+            for label, path in images or []:
+                content.append(label)
+                content.append(self._image_part(path))
+        except AIRequestError:
+            raise
+        except Exception as e:
+            raise AIRequestError(f"Error opening image for Gemini: {e}")
+        t1 = time.perf_counter()
+        self._ensure_configured()
+        try:
+            # 關掉 SDK 內建的重試: 它不經過 TokenBucket，還會和 call_ai_with_retry 的退避疊在一起
+            response = self.model.generate_content(content, generation_config=self.generation_config,
+                                                   request_options={'retry': None, 'timeout': GEMINI_REQUEST_TIMEOUT})
+        except Exception as e:
+            status = getattr(e, 'code', None)
+            status = status if isinstance(status, int) else None
+            # 只重試 429/5xx 與連線/逾時錯誤 (ConnectionError、TimeoutError 與 requests 的連線例外都是 OSError)
+            retryable = status == 429 or (status is not None and status >= 500) or isinstance(e, OSError)
+            raise AIRequestError(f"Gemini API Error: {e}", status=status, retryable=retryable) from e
+        finally:
+            t2 = time.perf_counter()
+            with self._lock:
+                self.timings.append(((t1 - t0) * 1000, (t2 - t1) * 1000))
+                del self.timings[:-GEMINI_TIMING_HISTORY]
+        try:
+            return response.text
+        except ValueError as e:
+            # 回應被安全過濾擋下或沒有內容，重送也一樣
+            raise AIRequestError(f"Gemini returned no text: {e}", retryable=False) from e
+
+    def report(self) -> str:
+        with self._lock:
+            timings = list(self.timings)
+        if not timings:
+            return f"Gemini {self.model_name}: setup {self.setup_ms:.0f} ms, no calls yet"
+        n = len(timings)
+        return (f"Gemini {self.model_name}: setup {self.setup_ms:.0f} ms (once), {n} calls, "
+                f"avg prepare {sum(t[0] for t in timings) / n:.0f} ms, "
+                f"avg request {sum(t[1] for t in timings) / n:.0f} ms")
+
+_GEMINI_CLIENTS = {}
+_GEMINI_CLIENTS_LOCK = threading.Lock()
+
+def get_gemini_client(api_key: str, model_name: str = None) -> GeminiClient:
+    """
+    取得 (api_key, 模型) 對應的共用 GeminiClient，第一次使用時建立。
+    """
+    if not api_key:
+        raise AIRequestError("API Key is missing.")
+    if not has_module('google.generativeai'):
+        raise AIRequestError("google-generativeai module not found.")
+    key = (api_key, model_name or GEMINI_MODEL)
+    with _GEMINI_CLIENTS_LOCK:
+        client = _GEMINI_CLIENTS.get(key)
+        if client is None:
+            client = GeminiClient(*key)
+            _GEMINI_CLIENTS[key] = client
+        return client
+
+def gemini_timing_report(api_key: str, model_name: str = None) -> Optional[str]:
+    """
+    已建立的 GeminiClient 的耗時統計 (見 GeminiClient.report)；還沒送過請求 (例如全部命中快取) 時回傳 None。
+    """
+    with _GEMINI_CLIENTS_LOCK:
+        client = _GEMINI_CLIENTS.get((api_key, model_name or GEMINI_MODEL))
+    return client.report() if client else None
+
+def _request_gemini(prompt, image_path=None, api_key=None, images=None) -> str:
+    """
+    實際呼叫 Gemini 並回傳文字；任何失敗都以 AIRequestError 拋出。
+    """
+    return get_gemini_client(api_key).generate(prompt, image_path, images=images)
+
+class AIResponseCache:
+    """
+    AI 回應的磁碟快取。key = (模型, prompt hash, 圖片內容 hash, generation config)，
+    同一張圖配同一個 prompt 重跑 (例如批次匯入中斷後重來) 不必再花額度。
+    - 超過 ttl_hours 的回應視為過期
+    - 總大小超過上限時刪除最久沒用到的 (見 DiskCacheDir)
+    - single-flight: 同一個 key 同時只送出一個請求，其他執行緒等結果
+    圖片內容 hash 取自共用的 FileHashIndex (與去背快取同一份)。
+    """
+    def __init__(self, cache_dir: str, ttl_hours: float, max_bytes: int, hashes: FileHashIndex):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_hours * 3600
+        self.hashes = hashes
+        self.disk = DiskCacheDir(cache_dir, max_bytes, '.json')
+        self._lock = threading.Lock()
+        self._in_flight = {} # key -> {'event': Event, 'result': ..., 'error': ...}
+
+    def make_key(self, model_name: str, prompt: str, image_path: Optional[Union[str, List[str]]],
+                 config: Dict[str, Any]) -> Optional[str]:
+        # image_path 可以是多張圖片的清單 (多圖一次分析)，依序串接各圖的內容 hash
+        import hashlib
+        paths = image_path if isinstance(image_path, list) else [image_path] if image_path else []
+        hashes = [self.hashes.content_hash(path) for path in paths]
+        if not all(hashes):
+            return None
+        image_hash = ','.join(hashes)
+        raw = json.dumps([model_name, hashlib.sha1(prompt.encode('utf-8')).hexdigest(), image_hash, config],
+                         sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry.get('created', 0) > self.ttl_seconds:
+            self.disk.remove(path)
+            return None
+        self.disk.touch(path)
+        return entry.get('text')
+
+    def put(self, key: str, text: str):
+        path = self._path(key)
+        data = json.dumps({'created': time.time(), 'text': text}, ensure_ascii=False).encode('utf-8')
+        try:
+            self.disk.write(path, data)
+        except OSError as e:
+            print(f"AI cache write error: {e}")
+
+    def get_or_call(self, key: str, fn) -> str:
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+
+        with self._lock:
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = {'event': threading.Event(), 'result': None, 'error': None}
+                self._in_flight[key] = flight
+        if not leader:
+            flight['event'].wait()
+            if flight['error'] is not None:
+                raise flight['error']
+            return flight['result']
+
+        try:
+            flight['result'] = fn()
+            if flight['result']:
+                self.put(key, flight['result'])
+            return flight['result']
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            flight['event'].set()
+
+AI_RESPONSE_CACHE = AIResponseCache(AI_CACHE_DIR, AI_CACHE_TTL_HOURS, AI_CACHE_MAX_BYTES, FILE_HASH_INDEX)
+
+def _call_gemini(prompt, image_path=None, api_key=None, use_cache: bool = True, before_request=None,
+                 images: Optional[List[Tuple[str, str]]] = None) -> str:
+    """
+    呼叫 Gemini (先查回應快取)；任何失敗都以 AIRequestError 拋出。
+    use_cache=False 時略過快取，一定送出請求。
+    before_request() 只在真的要送出請求時呼叫 (例如流量限制)，命中快取不受影響。
+    images: 多圖一次分析時的 (標籤, 路徑) 清單。
+    """
+    def _request():
+        if before_request:
+            before_request()
+        return _request_gemini(prompt, image_path, api_key, images=images)
+
+    if not (use_cache and AI_CACHE_ENABLED):
+        return _request()
+    cache_images = [image_path] if image_path else []
+    cache_images += [path for _, path in images or []]
+    # 標籤 (檔名) 會影響回應，和 prompt 一起列入 key
+    cache_prompt = prompt + ''.join(f"\n{label}" for label, _ in images or [])
+    key = AI_RESPONSE_CACHE.make_key(GEMINI_MODEL, cache_prompt, cache_images, GEMINI_GENERATION_CONFIG)
+    if not key:
+        return _request()
+    return AI_RESPONSE_CACHE.get_or_call(key, _request)
+
+def call_ai_api(prompt, image_path=None, api_key=None, use_cache: bool = True):
+    """
+    呼叫 Google Gemini API 進行分析。失敗時印出原因並回傳 None。
+    相同的 prompt + 圖片會直接使用快取的回應；use_cache=False 強制重新呼叫。
+    """
+    try:
+        return _call_gemini(prompt, image_path, api_key, use_cache=use_cache)
+    except AIRequestError as e:
+        print(e)
         return None
 
+def start_ai_request(window, event_key: str, prompt: str, image_path: Optional[str], api_key: str,
+                     use_cache: bool = True):
+    """
+    在背景執行緒呼叫 AI，完成後送出 event_key 事件，值為 (回應文字或 None, 錯誤訊息或 None, 耗時 ms)。
+    use_cache=False 時一定送出新請求 (例如每次都想要不同結果的穿搭推薦)。
+    """
+    def _worker():
+        t0 = time.perf_counter()
+        try:
+            text, error = _call_gemini(prompt, image_path, api_key, use_cache=use_cache), None
+        except AIRequestError as e:
+            text, error = None, str(e)
+        window.write_event_value(event_key, (text, error, (time.perf_counter() - t0) * 1000))
+
+    t = threading.Thread(target=_worker, daemon=True)
+    t.start()
+    return t
+
+class TokenBucket:
+    """
+    Token bucket 流量限制: 平均每秒 rate 個請求，最多可瞬間連發 capacity 個。
+    多個執行緒共用，acquire() 在沒有 token 時會等待。
+    """
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+def call_ai_with_retry(prompt, image_path=None, api_key=None, limiter: TokenBucket = None,
+                       max_retries: int = None, backoff: float = None, use_cache: bool = True,
+                       images: Optional[List[Tuple[str, str]]] = None) -> str:
+    """
+    呼叫 AI API，遇到 429 / 5xx 時以指數退避 (加上隨機抖動) 重試。
+    重試用盡或不可重試的錯誤以 AIRequestError 拋出。
+    """
+    import random
+    max_retries = AI_MAX_RETRIES if max_retries is None else max_retries
+    backoff = AI_BACKOFF_SECONDS if backoff is None else backoff
+    attempt = 0
+    while True:
+        try:
+            return _call_gemini(prompt, image_path, api_key, use_cache=use_cache,
+                                before_request=limiter.acquire if limiter else None, images=images)
+        except AIRequestError as e:
+            if not e.retryable or attempt >= max_retries:
+                raise
+            delay = backoff * (2 ** attempt) * (0.5 + random.random())
+            print(f"AI request failed ({e.status or 'network'}), retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+def analyze_concurrently(jobs: List[tuple], api_key: str, max_in_flight: int = None,
+                         requests_per_minute: float = None, progress_callback=None,
+                         use_cache: bool = True, should_cancel=None) -> List[Dict[str, Any]]:
+    """
+    平行送出多個 AI 分析請求。jobs 為 (prompt, image_path) 清單。
+    同時進行中的請求不超過 max_in_flight，整體速率由 token bucket 限制。
+    回傳與 jobs 順序相同的結果: {'text': 回應或 None, 'error': 錯誤訊息或 None}。
+    progress_callback(done, total, image_path) 在呼叫端執行緒執行，回傳 False 可中止 (未開始的請求會取消)。
+    should_cancel() 回傳 True 時，還沒送出的請求直接略過 (不花額度)。
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    total = len(jobs)
+    results = [{'text': None, 'error': '已取消'} for _ in jobs]
+    if total == 0:
+        return results
+
+    max_in_flight = max(1, min(max_in_flight or AI_MAX_IN_FLIGHT, total))
+    rpm = requests_per_minute or AI_REQUESTS_PER_MINUTE
+    limiter = TokenBucket(rpm / 60.0, max_in_flight)
+
+    def _run_job(prompt, image_path):
+        if should_cancel and should_cancel():
+            raise AIRequestError('已取消')
+        return call_ai_with_retry(prompt, image_path, api_key, limiter, use_cache=use_cache)
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        futures = {pool.submit(_run_job, prompt, image_path): i
+                   for i, (prompt, image_path) in enumerate(jobs)}
+        for done, future in enumerate(as_completed(futures), 1):
+            i = futures[future]
+            try:
+                results[i] = {'text': future.result(), 'error': None}
+            except Exception as e:
+                results[i] = {'text': None, 'error': str(e)}
+            if progress_callback and progress_callback(done, total, jobs[i][1]) is False:
+                for f in futures:
+                    f.cancel()
+                break
+    return results
+
 
 
 # =============================================================================
@@ -412,10 +1257,13 @@ class UserProfileManager:
             "climate_notes": ""
         }
 
-class WardrobeManager:
+class JsonWardrobeStorage:
+    """
+    衣櫃資料的 JSON 儲存引擎 (預設)。
+    每次異動都會整份重寫 wardrobe.json，並保留一份 .bak 備份。
+    """
     def __init__(self, filepath: str):
         self.filepath = filepath
-        self.items = self.load()
 
     def load(self) -> List[Dict[str, Any]]:
         if not os.path.exists(self.filepath):
@@ -434,63 +1282,454 @@ class WardrobeManager:
             sg.popup_error(f"讀取衣櫃資料失敗: {e}")
             return []
 
+    def save_all(self, items: List[Dict[str, Any]]):
+        self._write_snapshot(json.dumps(items, ensure_ascii=False, indent=2))
+
+    def _write_snapshot(self, text: str):
+        temp_path = f"{self.filepath}.tmp"
+        self._write_temp(temp_path, text)
+        self._replace_snapshot(temp_path)
+
+    @staticmethod
+    def _write_temp(temp_path: str, text: str):
+        # Write to a temp file first
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _replace_snapshot(self, temp_path: str):
+        # Create a backup first
+        if os.path.exists(self.filepath):
+            backup_path = f"{self.filepath}.bak"
+            try:
+                import shutil
+                shutil.copy2(self.filepath, backup_path)
+            except Exception as e:
+                print(f"Warning: Failed to create backup: {e}")
+
+        # Atomic rename (replace)
+        os.replace(temp_path, self.filepath)
+
+    def put_item(self, item: Dict[str, Any], items: List[Dict[str, Any]]):
+        # JSON 沒有單筆寫入，只能整份重寫
+        self.save_all(items)
+
+    def delete_item(self, item_id: str, items: List[Dict[str, Any]]):
+        self.save_all(items)
+
+    def apply_changes(self, changes: Dict[str, Optional[Dict[str, Any]]], items: List[Dict[str, Any]]):
+        # changes: id -> item (新增/修改) 或 None (刪除)
+        self.save_all(items)
+
+class JournalJsonStorage(JsonWardrobeStorage):
+    """
+    wardrobe.json + 追加式異動日誌 (wardrobe.json.journal)。
+    每次異動只在日誌尾端追加一行 JSON，寫入量與異動大小成正比；
+    日誌超過門檻時才在背景執行緒把目前狀態寫回 wardrobe.json 並清空日誌。
+    啟動時先讀 wardrobe.json，再依序重播日誌。
+    """
+    def __init__(self, filepath: str, compact_threshold: int = None):
+        super().__init__(filepath)
+        self.journal_path = f"{filepath}.journal"
+        self.compact_threshold = compact_threshold or JOURNAL_COMPACT_BYTES
+        self._lock = threading.Lock()
+        self._compactor = None
+        self._generation = 0 # save_all 每寫一次完整快照就加一，讓進行中的壓縮作廢
+
+    def load(self) -> List[Dict[str, Any]]:
+        items = super().load()
+        if not os.path.exists(self.journal_path):
+            return items
+
+        index = {item.get('id'): i for i, item in enumerate(items)}
+        good_offset = 0
+        with open(self.journal_path, 'rb') as f:
+            for raw in f:
+                try:
+                    entry = json.loads(raw.decode('utf-8'))
+                except (UnicodeDecodeError, json.JSONDecodeError):
+                    # 最後一行寫到一半就當機: 捨棄殘缺的部分
+                    print(f"Warning: {self.journal_path} has a torn entry at byte {good_offset}, truncating.")
+                    break
+                good_offset += len(raw)
+                self._replay(entry, items, index)
+
+        if good_offset < os.path.getsize(self.journal_path):
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(good_offset)
+        return [item for item in items if item is not None]
+
+    def _replay(self, entry: Dict[str, Any], items: List[Any], index: Dict[str, int]):
+        # 重播是冪等的: 同一筆 put/del 套用兩次結果相同
+        if entry.get('op') == 'batch':
+            # 交易寫成單一行，整批要嘛全部重播、要嘛整行被當成殘缺捨棄
+            for sub in entry.get('ops', []):
+                self._replay(sub, items, index)
+        elif entry.get('op') == 'put':
+            item = entry['item']
+            pos = index.get(item.get('id'))
+            if pos is None:
+                index[item.get('id')] = len(items)
+                items.append(item)
+            else:
+                items[pos] = item
+        elif entry.get('op') == 'del':
+            pos = index.pop(entry.get('id'), None)
+            if pos is not None:
+                items[pos] = None
+
+    def _append(self, entries: List[Dict[str, Any]], items: List[Dict[str, Any]]):
+        data = ''.join(json.dumps(e, ensure_ascii=False) + '\n' for e in entries)
+        with self._lock:
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            journal_size = os.path.getsize(self.journal_path)
+        if journal_size >= self.compact_threshold:
+            self.compact(items)
+
+    def put_item(self, item: Dict[str, Any], items: List[Dict[str, Any]]):
+        self._append([{'op': 'put', 'item': item}], items)
+
+    def delete_item(self, item_id: str, items: List[Dict[str, Any]]):
+        self._append([{'op': 'del', 'id': item_id}], items)
+
+    def apply_changes(self, changes: Dict[str, Optional[Dict[str, Any]]], items: List[Dict[str, Any]]):
+        ops = [{'op': 'put', 'item': item} if item is not None else {'op': 'del', 'id': item_id}
+               for item_id, item in changes.items()]
+        self._append([{'op': 'batch', 'ops': ops}], items)
+
+    def save_all(self, items: List[Dict[str, Any]]):
+        text = json.dumps(items, ensure_ascii=False, indent=2)
+        with self._lock:
+            self._generation += 1
+            self._write_snapshot(text)
+            open(self.journal_path, 'w').close()
+
+    def compact(self, items: List[Dict[str, Any]], background: bool = True):
+        """
+        把目前狀態折疊成新的 wardrobe.json，並移除已包含在內的日誌。
+        序列化在呼叫端完成 (避免背景執行緒讀到正在修改的 dict)，寫檔交給背景執行緒。
+        """
+        if self._compactor and self._compactor.is_alive():
+            return
+        with self._lock:
+            text = json.dumps(items, ensure_ascii=False, indent=2)
+            covered = os.path.getsize(self.journal_path) if os.path.exists(self.journal_path) else 0
+            generation = self._generation
+
+        self._compactor = threading.Thread(target=self._run_compaction, args=(text, covered, generation))
+        self._compactor.start()
+        if not background:
+            self._compactor.join()
+
+    def _run_compaction(self, text: str, covered: int, generation: int):
+        # 暫存檔與 save_all 的分開；慢的 fsync 在鎖外做，換檔與截斷日誌在鎖內一次完成
+        temp_path = f"{self.filepath}.compact.tmp"
+        try:
+            self._write_temp(temp_path, text)
+            with self._lock:
+                if generation != self._generation:
+                    # 壓縮期間 save_all 已寫入較新的快照並清空日誌，這份舊快照作廢
+                    os.remove(temp_path)
+                    return
+                self._replace_snapshot(temp_path)
+                # 壓縮期間追加的日誌要保留下來
+                with open(self.journal_path, 'rb') as f:
+                    f.seek(covered)
+                    tail = f.read()
+                temp_path = f"{self.journal_path}.tmp"
+                with open(temp_path, 'wb') as f:
+                    f.write(tail)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, self.journal_path)
+        except Exception as e:
+            print(f"Warning: journal compaction failed: {e}")
+
+class SQLiteWardrobeStorage:
+    """
+    衣櫃資料的 SQLite 儲存引擎。
+    每件衣服存成一列 (id + JSON)，新增/修改/刪除只會寫入單一列，
+    不必因為改一個狀態就重寫整份檔案。
+    """
+    def __init__(self, filepath: str, import_from: Optional[str] = None):
+        import sqlite3
+        self.filepath = filepath
+        is_new = not os.path.exists(filepath)
+        self.conn = sqlite3.connect(filepath, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "id TEXT NOT NULL UNIQUE, "
+            "data TEXT NOT NULL)"
+        )
+        self.conn.commit()
+
+        # 第一次建立資料庫時，自動匯入既有的 wardrobe.json
+        if is_new and import_from and os.path.exists(import_from):
+            count = self.import_json(import_from)
+            print(f"Imported {count} items from {import_from} into {filepath}")
+
+    def load(self) -> List[Dict[str, Any]]:
+        items = []
+        try:
+            for (data,) in self.conn.execute("SELECT data FROM items ORDER BY seq"):
+                items.append(json.loads(data))
+        except Exception as e:
+            sg.popup_error(f"讀取衣櫃資料失敗: {e}")
+            return []
+        return items
+
+    def save_all(self, items: List[Dict[str, Any]]):
+        with self.conn:
+            self.conn.execute("DELETE FROM items")
+            self.conn.executemany(
+                "INSERT INTO items (id, data) VALUES (?, ?)",
+                [(item['id'], json.dumps(item, ensure_ascii=False)) for item in items]
+            )
+
+    def put_item(self, item: Dict[str, Any], items: List[Dict[str, Any]]):
+        # UPSERT 保留原本的 seq，維持衣櫃清單的順序
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO items (id, data) VALUES (?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET data = excluded.data",
+                (item['id'], json.dumps(item, ensure_ascii=False))
+            )
+
+    def delete_item(self, item_id: str, items: List[Dict[str, Any]]):
+        with self.conn:
+            self.conn.execute("DELETE FROM items WHERE id = ?", (item_id,))
+
+    def apply_changes(self, changes: Dict[str, Optional[Dict[str, Any]]], items: List[Dict[str, Any]]):
+        # 整批在同一個 SQLite transaction 內完成，失敗時自動 rollback
+        puts = [(iid, json.dumps(item, ensure_ascii=False)) for iid, item in changes.items() if item is not None]
+        dels = [(iid,) for iid, item in changes.items() if item is None]
+        with self.conn:
+            if dels:
+                self.conn.executemany("DELETE FROM items WHERE id = ?", dels)
+            if puts:
+                self.conn.executemany(
+                    "INSERT INTO items (id, data) VALUES (?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET data = excluded.data",
+                    puts
+                )
+
+    def import_json(self, json_path: str) -> int:
+        """
+        從 wardrobe.json 匯入 (覆蓋資料庫內容)，回傳匯入件數。
+        """
+        items = JsonWardrobeStorage(json_path).load()
+        self.save_all(items)
+        return len(items)
+
+    def export_json(self, json_path: str) -> int:
+        """
+        匯出成與 wardrobe.json 相同格式的檔案，回傳匯出件數。
+        """
+        items = self.load()
+        JsonWardrobeStorage(json_path).save_all(items)
+        return len(items)
+
+def make_wardrobe_storage(filepath: str, backend: str = None):
+    """
+    依設定建立儲存引擎: 'journal' (預設)、'json' 或 'sqlite'。
+    使用 sqlite 時，資料庫放在 wardrobe.json 旁 (副檔名 .db)，
+    第一次啟動會自動匯入原本的 JSON。
+    """
+    backend = backend or WARDROBE_STORAGE
+    if backend == 'sqlite':
+        db_path = os.path.splitext(filepath)[0] + '.db'
+        return SQLiteWardrobeStorage(db_path, import_from=filepath)
+    if backend == 'journal':
+        return JournalJsonStorage(filepath)
+    return JsonWardrobeStorage(filepath)
+
+class TransactionError(Exception):
+    """衣櫃交易失敗 (已還原記憶體中的變更)"""
+
+class WardrobeManager:
+    def __init__(self, filepath: str, storage=None):
+        self.filepath = filepath
+        self.storage = storage or make_wardrobe_storage(filepath)
+        self.items = self.load()
+        self._reindex()
+        self._pending = None # 交易中尚未寫入的異動 (id -> item 或 None)
+        self._columns = None
+        self._columns_version = None
+        self._seq_lock = threading.Lock()
+        self._seq = {}
+        for item in self.items:
+            self._track_id(item['id'])
+
+    def load(self) -> List[Dict[str, Any]]:
+        return self.storage.load()
+
+    def _reindex(self):
+        # id -> item 索引，讓查詢單品不必線性掃描整個衣櫃
+        self._index = {item['id']: item for item in self.items}
+        self._version = getattr(self, '_version', 0) + 1
+
+    def columns(self) -> 'WardrobeColumns':
+        """
+        取得欄位式資料 (價格、穿著次數、狀態、分類)，供統計與篩選使用。
+        衣櫃有異動時才重建。
+        """
+        if self._columns is None or self._columns_version != self._version:
+            self._columns = WardrobeColumns(self.items)
+            self._columns_version = self._version
+        return self._columns
+
+    def get(self, item_id: str) -> Optional[Dict[str, Any]]:
+        return self._index.get(item_id)
+
+    def get_many(self, item_ids: List[str]) -> List[Dict[str, Any]]:
+        """
+        依序取得多件單品，找不到的 ID 直接略過。
+        """
+        return [self._index[iid] for iid in item_ids if iid in self._index]
+
     def save(self):
         try:
-            # Create a backup first
-            if os.path.exists(self.filepath):
-                backup_path = f"{self.filepath}.bak"
-                try:
-                    import shutil
-                    shutil.copy2(self.filepath, backup_path)
-                except Exception as e:
-                    print(f"Warning: Failed to create backup: {e}")
+            self.storage.save_all(self.items)
+            return True
+        except Exception as e:
+            sg.popup_error(f"儲存衣櫃資料失敗: {e}")
+            return False
 
-            # Write to a temp file first
-            temp_path = f"{self.filepath}.tmp"
-            with open(temp_path, 'w', encoding='utf-8') as f:
-                json.dump(self.items, f, ensure_ascii=False, indent=2)
-            
-            # Atomic rename (replace)
-            if os.path.exists(self.filepath):
-                os.remove(self.filepath)
-            os.rename(temp_path, self.filepath)
-            
+    def _persist_item(self, item: Dict[str, Any]):
+        self._version += 1
+        if self._pending is not None:
+            self._pending[item['id']] = item
+            return True
+        try:
+            self.storage.put_item(item, self.items)
+            return True
+        except Exception as e:
+            sg.popup_error(f"儲存衣櫃資料失敗: {e}")
+            return False
+
+    def _persist_delete(self, item_id: str):
+        self._version += 1
+        if self._pending is not None:
+            self._pending[item_id] = None
+            return True
+        try:
+            self.storage.delete_item(item_id, self.items)
             return True
         except Exception as e:
             sg.popup_error(f"儲存衣櫃資料失敗: {e}")
             return False
 
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        交易: 區塊內的所有異動只在記憶體中進行，結束時一次寫入。
+        區塊內發生例外或寫入失敗時，記憶體中的資料會還原成交易前的狀態；
+        寫入失敗會轉成 TransactionError，區塊內的其他例外則原樣拋出。
+        巢狀使用時併入外層交易。
+
+        with wardrobe_mgr.transaction():
+            wardrobe_mgr.set_status(a, 'laundry')
+            wardrobe_mgr.delete_item(b)
+        """
+        if self._pending is not None:
+            yield self
+            return
+
+        snapshot = copy.deepcopy(self.items)
+        self._pending = {}
+        try:
+            yield self
+            if self._pending:
+                try:
+                    self.storage.apply_changes(self._pending, self.items)
+                except Exception as e:
+                    # 只有寫入失敗才算儲存錯誤；區塊內的其他例外照原樣往外拋
+                    sg.popup_error(f"儲存衣櫃資料失敗，已還原變更: {e}")
+                    raise TransactionError(str(e)) from e
+        except Exception:
+            self.items = snapshot
+            self._reindex()
+            raise
+        finally:
+            self._pending = None
+
+    def bulk_update(self, item_ids: List[str], changes: Dict[str, Any]) -> int:
+        """
+        將同一組變更套用到多件衣服，只寫入一次。回傳更新件數，失敗回傳 0。
+        """
+        count = 0
+        try:
+            with self.transaction():
+                for item in self.get_many(item_ids):
+                    item.update(changes)
+                    self._persist_item(item)
+                    count += 1
+        except TransactionError:
+            return 0
+        return count
+
+    def bulk_delete(self, item_ids: List[str]) -> int:
+        """
+        一次刪除多件衣服 (清單只重建一次)，只寫入一次。回傳刪除件數，失敗回傳 0。
+        """
+        targets = {iid for iid in item_ids if iid in self._index}
+        if not targets:
+            return 0
+        try:
+            with self.transaction():
+                self.items = [item for item in self.items if item['id'] not in targets]
+                for iid in targets:
+                    del self._index[iid]
+                    self._persist_delete(iid)
+        except TransactionError:
+            return 0
+        return len(targets)
+
     def add_item(self, item: Dict[str, Any]):
         # 預設狀態為 'available' (在衣櫃中)
         if 'status' not in item:
             item['status'] = 'available'
         self.items.append(item)
-        self.save()
+        self._index[item['id']] = item
+        with self._seq_lock:
+            self._track_id(item['id'])
+        self._persist_item(item)
 
     def set_status(self, item_id: str, status: str):
         """
         設定衣服狀態: available, laundry, lent, repair
         """
-        for item in self.items:
-            if item['id'] == item_id:
-                item['status'] = status
-                break
-        self.save()
+        item = self.get(item_id)
+        if item:
+            item['status'] = status
+            self._persist_item(item)
 
     def delete_item(self, item_id: str) -> bool:
-        original_count = len(self.items)
+        if item_id not in self._index:
+            return False
+        del self._index[item_id]
         self.items = [item for item in self.items if item['id'] != item_id]
-        if len(self.items) < original_count:
-            self.save()
-            return True
-        return False
+        self._persist_delete(item_id)
+        return True
 
     def update_item(self, item_id: str, updates: Dict[str, Any]):
-        for item in self.items:
-            if item['id'] == item_id:
-                item.update(updates)
-                break
-        self.save()
+        item = self.get(item_id)
+        if item:
+            item.update(updates)
+            self._persist_item(item)
+
+    def _track_id(self, item_id: str):
+        # 記錄 prefix (type_YYYYMMDD) -> 最大序號
+        prefix, _, seq = str(item_id).rpartition('_')
+        if prefix and seq.isdigit():
+            if int(seq) > self._seq.get(prefix, 0):
+                self._seq[prefix] = int(seq)
 
     def generate_id(self, item_type: str) -> str:
         # 簡單的 ID 產生邏輯: type_date_seq
@@ -498,46 +1737,314 @@ class WardrobeManager:
         today = datetime.datetime.now().strftime("%Y%m%d")
         prefix = f"{item_type}_{today}"
         
-        # 找出當天同類型的最大序號
-        max_seq = 0
-        for item in self.items:
-            if item['id'].startswith(prefix):
+        # 序號在產生時就保留下來，多個匯入執行緒同時取號也不會重複；
+        # 刪除衣服不會讓序號倒退，避免穿搭紀錄中的舊 ID 被重新使用
+        with self._seq_lock:
+            seq = self._seq.get(prefix, 0) + 1
+            self._seq[prefix] = seq
+        
+        return f"{prefix}_{seq:03d}"
+
+# =============================================================================
+# 欄位式統計資料 (大衣櫃用)
+# =============================================================================
+
+class WardrobeColumns:
+    """
+    欄位式儲存: 價格、穿著次數、幣別、狀態、分類各存成一個 array，
+    字串欄位轉成代碼，統計與篩選時只需掃描連續的數字陣列。
+    """
+    def __init__(self, items: List[Dict[str, Any]]):
+        from array import array
+        self.ids = []
+        self.names = []
+        self.price = array('d')
+        self.wear_count = array('l')
+        self.currency = array('H')
+        self.status = array('H')
+        self.category = array('H')
+        self.currency_names, self._currency_codes = [], {}
+        self.status_names, self._status_codes = [], {}
+        self.category_names, self._category_codes = [], {}
+
+        for item in items:
+            ai_data = item.get('ai') or {}
+            self.ids.append(item['id'])
+            self.names.append(item.get('name', ''))
+            self.price.append(self._number(item.get('price', 0)))
+            self.wear_count.append(int(self._number(item.get('wear_count', 0))))
+            self.currency.append(self._code(item.get('currency', 'TWD'), self.currency_names, self._currency_codes))
+            self.status.append(self._code(item.get('status', 'available'), self.status_names, self._status_codes))
+            self.category.append(self._code(get_category(ai_data.get('type', '')), self.category_names, self._category_codes))
+
+    @staticmethod
+    def _number(value) -> float:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return 0.0
+
+    @staticmethod
+    def _code(value: str, names: List[str], codes: Dict[str, int]) -> int:
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(names)
+            names.append(value)
+        return code
+
+    def __len__(self):
+        return len(self.ids)
+
+    def filter(self, status: Optional[str] = None, category: Optional[str] = None) -> List[int]:
+        """
+        回傳符合條件的列索引 (與 wardrobe_mgr.items 的順序相同)。
+        """
+        rows = range(len(self.ids))
+        if status is not None:
+            code = self._status_codes.get(status)
+            if code is None:
+                return []
+            rows = [i for i in rows if self.status[i] == code]
+        if category is not None:
+            code = self._category_codes.get(category)
+            if code is None:
+                return []
+            rows = [i for i in rows if self.category[i] == code]
+        return list(rows)
+
+class TextBlobStore:
+    """
+    以內容雜湊為 key 的文字儲存 (追加式 JSONL)。
+    相同的文字只存一次，其他地方只保留雜湊參照。
+    """
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+        self.blobs = {}
+        if not os.path.exists(filepath):
+            return
+        offset = 0
+        with open(filepath, 'rb') as f:
+            for raw in f:
+                if not raw.endswith(b'\n'):
+                    break
                 try:
-                    seq = int(item['id'].split('_')[-1])
-                    if seq > max_seq:
-                        max_seq = seq
-                except:
+                    entry = json.loads(raw.decode('utf-8'))
+                    self.blobs[entry['h']] = entry['t']
+                except (UnicodeDecodeError, json.JSONDecodeError, KeyError):
                     pass
-        
-        return f"{prefix}_{max_seq + 1:03d}"
+                offset += len(raw)
+        if offset < os.path.getsize(filepath):
+            with open(filepath, 'r+b') as f:
+                f.truncate(offset)
+
+    @staticmethod
+    def hash_text(text: str) -> str:
+        import hashlib
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def put(self, text: str) -> str:
+        h = self.hash_text(text)
+        with self._lock:
+            if h not in self.blobs:
+                with open(self.filepath, 'ab') as f:
+                    f.write((json.dumps({'h': h, 't': text}, ensure_ascii=False) + '\n').encode('utf-8'))
+                self.blobs[h] = text
+        return h
+
+    def get(self, h: str) -> str:
+        return self.blobs.get(h, '')
+
+# 穿搭紀錄中改存雜湊參照的文字欄位 (存成 'title#' 等 key)
+OOTD_BLOB_FIELDS = ('title', 'reason', 'notes')
+
+def encode_ootd_log(log: Dict[str, Any], blobs: TextBlobStore) -> Dict[str, Any]:
+    row = {}
+    for k, v in log.items():
+        if k in OOTD_BLOB_FIELDS and isinstance(v, str):
+            row[f"{k}#"] = blobs.put(v)
+        else:
+            row[k] = v
+    return row
+
+def decode_ootd_log(row: Dict[str, Any], blobs: TextBlobStore) -> Dict[str, Any]:
+    log = {}
+    for k, v in row.items():
+        if k.endswith('#') and k[:-1] in OOTD_BLOB_FIELDS:
+            log[k[:-1]] = blobs.get(v)
+        else:
+            log[k] = v
+    return log
+
+def migrate_ootd_log(src_path: str, dst_path: str) -> int:
+    """
+    一次性轉換: 舊版 ootd_log.json (整份 JSON 陣列) -> ootd_log.jsonl (一行一筆)。
+    依日期做穩定排序，讓 JSONL 維持時間順序；文字欄位存進 blob 檔去除重複。回傳轉換筆數。
+    """
+    with open(src_path, 'r', encoding='utf-8') as f:
+        logs = json.load(f)
+    if not isinstance(logs, list):
+        logs = []
+    logs.sort(key=lambda x: x.get('date', ''))
+
+    blobs = TextBlobStore(f"{os.path.splitext(dst_path)[0]}.blobs.jsonl")
+    temp_path = f"{dst_path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        for log in logs:
+            f.write(json.dumps(encode_ootd_log(log, blobs), ensure_ascii=False) + '\n')
+    os.replace(temp_path, dst_path)
+    print(f"Migrated {len(logs)} OOTD logs from {src_path} to {dst_path} ({len(blobs.blobs)} unique texts)")
+    return len(logs)
 
 class OOTDLogManager:
-    def __init__(self, filepath):
+    """
+    穿搭紀錄，存成 JSONL (一行一筆，依時間追加)。
+    啟動時只掃過檔案建立稀疏的「日期 -> 位移」索引，不會把全部紀錄載入記憶體；
+    用 iter_logs(since, until) 或 tail(n) 讀取需要的部分。
+    title / reason / notes 的內文存在旁邊的 .blobs.jsonl，紀錄本身只存雜湊。
+    """
+    INDEX_STRIDE = 64 # 每幾筆紀錄記一個索引點
+
+    def __init__(self, filepath: str, legacy_path: Optional[str] = None):
         self.filepath = filepath
-        self.logs = self.load()
+        self._lock = threading.Lock()
+        if legacy_path and not os.path.exists(filepath) and os.path.exists(legacy_path):
+            try:
+                migrate_ootd_log(legacy_path, filepath)
+            except Exception as e:
+                sg.popup_error(f"轉換舊版穿搭紀錄失敗: {e}")
+        self.blobs = TextBlobStore(f"{os.path.splitext(filepath)[0]}.blobs.jsonl")
+        self._build_index()
 
-    def load(self) -> List[Dict[str, Any]]:
-        if os.path.exists(self.filepath):
+    def _build_index(self):
+        self._index = [] # [(date, byte offset)]
+        self.count = 0
+        if not os.path.exists(self.filepath):
+            return
+        offset = 0
+        with open(self.filepath, 'rb') as f:
+            for raw in f:
+                if not raw.endswith(b'\n'):
+                    # 最後一行寫到一半: 捨棄
+                    break
+                if raw.strip():
+                    if self.count % self.INDEX_STRIDE == 0:
+                        row = self._parse_row(raw)
+                        self._index.append(((row or {}).get('date', ''), offset))
+                    self.count += 1
+                offset += len(raw)
+        if offset < os.path.getsize(self.filepath):
+            with open(self.filepath, 'r+b') as f:
+                f.truncate(offset)
+
+    @staticmethod
+    def _parse_row(raw: bytes) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads(raw.decode('utf-8'))
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            return None
+
+    def iter_logs(self, since: Optional[str] = None, until: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """
+        依時間順序逐筆產生紀錄。since / until 為日期字串 (例如 '2025-12-01')，皆包含當天。
+        """
+        if not os.path.exists(self.filepath):
+            return
+        start = 0
+        if since:
+            import bisect
+            pos = bisect.bisect_left([d for d, _ in self._index], since)
+            if pos > 0:
+                start = self._index[pos - 1][1]
+
+        with open(self.filepath, 'rb') as f:
+            f.seek(start)
+            for raw in f:
+                row = self._parse_row(raw)
+                if row is None:
+                    continue
+                date = row.get('date', '')
+                if since and date < since:
+                    continue
+                if until and date[:len(until)] > until:
+                    break
+                yield decode_ootd_log(row, self.blobs)
+
+    def _tail_rows(self, n: int) -> List[Dict[str, Any]]:
+        if n <= 0 or not os.path.exists(self.filepath):
+            return []
+        block_size = 64 * 1024
+        with open(self.filepath, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            data = b''
+            while pos > 0 and data.count(b'\n') <= n:
+                read_size = min(block_size, pos)
+                pos -= read_size
+                f.seek(pos)
+                data = f.read(read_size) + data
+        lines = [line for line in data.split(b'\n') if line.strip()]
+        if pos > 0:
+            lines = lines[1:] # 第一行可能不完整
+        rows = [self._parse_row(line) for line in lines[-n:]]
+        return [row for row in rows if row is not None]
+
+    def tail(self, n: int) -> List[Dict[str, Any]]:
+        """
+        從檔案尾端往回讀，取得最近 n 筆紀錄 (時間由舊到新)。
+        """
+        return [decode_ootd_log(row, self.blobs) for row in self._tail_rows(n)]
+
+    def find_duplicate(self, log: Dict[str, Any], window_minutes: int = None) -> Optional[Dict[str, Any]]:
+        """
+        檢查最近是否已記錄過同一套穿搭 (相同單品與文字，且在時間窗內)，
+        例如重複解析同一段 AI 回應。找到時回傳該筆紀錄。
+        """
+        window_minutes = DUPLICATE_LOG_WINDOW_MINUTES if window_minutes is None else window_minutes
+        try:
+            log_time = datetime.datetime.strptime(log.get('date', ''), "%Y-%m-%d %H:%M")
+        except ValueError:
+            return None
+
+        fingerprint = (sorted(log.get('item_ids') or []),
+                       [TextBlobStore.hash_text(log.get(k) or '') for k in OOTD_BLOB_FIELDS])
+        for row in reversed(self._tail_rows(DUPLICATE_LOG_SCAN)):
             try:
-                with open(self.filepath, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except:
-                return []
-        return []
+                row_time = datetime.datetime.strptime(row.get('date', ''), "%Y-%m-%d %H:%M")
+            except ValueError:
+                continue
+            if abs((log_time - row_time).total_seconds()) > window_minutes * 60:
+                continue
+            row_fp = (sorted(row.get('item_ids') or []),
+                      [row.get(f"{k}#") or TextBlobStore.hash_text(row.get(k) or '') for k in OOTD_BLOB_FIELDS])
+            if row_fp == fingerprint:
+                return decode_ootd_log(row, self.blobs)
+        return None
 
-    def save(self):
+    def add_log(self, log: Dict[str, Any]) -> bool:
+        """
+        追加一筆穿搭紀錄。若是時間窗內的重複紀錄則略過並回傳 False。
+        """
+        if self.find_duplicate(log):
+            return False
         try:
-            with open(self.filepath, 'w', encoding='utf-8') as f:
-                json.dump(self.logs, f, ensure_ascii=False, indent=2)
+            with self._lock:
+                # 先寫 blob 再寫紀錄，當機時不會留下指向不存在內文的紀錄
+                row = encode_ootd_log(log, self.blobs)
+                line = (json.dumps(row, ensure_ascii=False) + '\n').encode('utf-8')
+                with open(self.filepath, 'ab') as f:
+                    offset = f.tell()
+                    f.write(line)
+                if self.count % self.INDEX_STRIDE == 0:
+                    self._index.append((log.get('date', ''), offset))
+                self.count += 1
+            return True
         except Exception as e:
             sg.popup_error(f"儲存穿搭紀錄失敗: {e}")
-
-    def add_log(self, log: Dict[str, Any]):
-        self.logs.append(log)
-        self.save()
+            return False
 
 class CurrencyManager:
-    def __init__(self):
+    def __init__(self, cache_path: Optional[str] = None):
         self.base_currency = 'TWD'
         self.rates = {
             'TWD': 1.0,
@@ -548,10 +2055,44 @@ class CurrencyManager:
             'KRW': 0.024
         }
         self.last_updated = None
-        self.update_rates()
+        self.cache_path = cache_path
+        # 啟動時只讀本機快取，不連網；網路更新交給 start_background_refresh
+        self.load_cache()
+
+    def load_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('base') == self.base_currency and data.get('rates'):
+                self.rates = data['rates']
+                self.last_updated = datetime.datetime.fromisoformat(data['updated_at'])
+        except Exception as e:
+            print(f"讀取匯率快取失敗: {e}")
 
-    def update_rates(self):
-        """嘗試從網路更新匯率 (使用 open.er-api.com)"""
+    def save_cache(self):
+        if not self.cache_path:
+            return
+        try:
+            temp_path = f"{self.cache_path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'base': self.base_currency,
+                    'updated_at': self.last_updated.isoformat(),
+                    'rates': self.rates
+                }, f, ensure_ascii=False)
+            os.replace(temp_path, self.cache_path)
+        except Exception as e:
+            print(f"儲存匯率快取失敗: {e}")
+
+    def is_cache_fresh(self) -> bool:
+        if not self.last_updated:
+            return False
+        return datetime.datetime.now() - self.last_updated < datetime.timedelta(hours=CURRENCY_CACHE_TTL_HOURS)
+
+    def update_rates(self) -> bool:
+        """嘗試從網路更新匯率 (使用 open.er-api.com)，成功時寫入快取"""
         try:
             url = f"https://open.er-api.com/v6/latest/{self.base_currency}"
             with urllib.request.urlopen(url, timeout=3) as response:
@@ -561,8 +2102,27 @@ class CurrencyManager:
                     self.last_updated = datetime.datetime.now()
                     # 確保常用貨幣存在 (API 回傳的 key 通常是大寫)
                     print("匯率更新成功！")
+                    self.save_cache()
+                    return True
         except Exception as e:
             print(f"匯率更新失敗，使用預設值: {e}")
+        return False
+
+    def start_background_refresh(self, window=None):
+        """
+        快取過期時在背景執行緒更新匯率，完成後送出 -RATES-UPDATED- 事件。
+        快取仍有效時完全不連網。
+        """
+        if self.is_cache_fresh():
+            return None
+
+        def _worker():
+            if self.update_rates() and window is not None:
+                window.write_event_value('-RATES-UPDATED-', self.last_updated)
+
+        t = threading.Thread(target=_worker, daemon=True)
+        t.start()
+        return t
 
     def convert(self, amount: float, from_curr: str, to_curr: str = 'TWD') -> float:
         if from_curr == to_curr:
@@ -649,48 +2209,465 @@ def build_add_item_prompt(profile: Dict[str, Any], item_info: Dict[str, str]) ->
 }}
 ```
 
-如果圖片已上傳，請分析並回傳以下 JSON 結構：
+如果圖片已上傳，請分析並回傳以下 JSON 結構：
+
+```json
+{{
+  "ok": true,
+  "message": "給使用者的簡短建議或鼓勵",
+  "data": {{
+    "type": "衣服類型 (如: 外套, 洋裝, 襯衫)",
+    "color": "主色系",
+    "styleTags": ["標籤1", "標籤2", ...],
+    "seasons": ["季節1", ...],
+    "occasions": ["場合1", ...],
+    "lengthDesc": "長度描述...",
+    "bodyEffect": "修飾效果分析...",
+    "notes": "搭配建議..."
+  }}
+}}
+```
+"""
+    return prompt.strip()
+
+class ThumbnailCache:
+    """
+    縮圖的磁碟快取。key = (原圖路徑, 修改時間, 檔案大小, 目標尺寸)，
+    原圖一改動 key 就不同，不會拿到舊縮圖。
+    總大小超過上限時，刪除最久沒用到的縮圖 (見 DiskCacheDir)。
+    """
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.disk = DiskCacheDir(cache_dir, max_bytes, '.png')
+
+    def _key_path(self, image_path: str, size: tuple) -> Optional[str]:
+        import hashlib
+        try:
+            st = os.stat(image_path)
+        except OSError:
+            return None
+        raw = f"{os.path.abspath(image_path)}|{st.st_mtime_ns}|{st.st_size}|{size[0]}x{size[1]}"
+        return os.path.join(self.cache_dir, hashlib.sha1(raw.encode('utf-8')).hexdigest() + '.png')
+
+    def get(self, image_path: str, size: tuple) -> Optional[bytes]:
+        path = self._key_path(image_path, size)
+        if not path:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        self.disk.touch(path)
+        return data
+
+    def put(self, image_path: str, size: tuple, data: bytes):
+        path = self._key_path(image_path, size)
+        if not path:
+            return
+        try:
+            self.disk.write(path, data)
+        except OSError as e:
+            print(f"Thumbnail cache write error: {e}")
+
+THUMBNAIL_CACHE = ThumbnailCache(THUMB_CACHE_DIR, THUMB_CACHE_MAX_BYTES)
+
+def resize_image_to_bytes(image_path: str, size: tuple, use_cache: bool = True) -> Optional[bytes]:
+    """
+    讀取圖片並縮放，回傳 PNG bytes 給 sg.Image 使用。
+    結果會存進磁碟快取，同一張圖同一尺寸第二次起直接讀快取。
+    如果沒有安裝 Pillow 或讀取失敗，回傳 None。
+    """
+    if not HAS_PIL:
+        return None
+    
+    try:
+        if not os.path.exists(image_path):
+            return None
+
+        if use_cache:
+            cached = THUMBNAIL_CACHE.get(image_path, size)
+            if cached:
+                return cached
+            
+        img = lazy_import('PIL.Image').open(image_path)
+        img.thumbnail(size)
+        
+        bio = io.BytesIO()
+        img.save(bio, format="PNG")
+        data = bio.getvalue()
+        if use_cache:
+            THUMBNAIL_CACHE.put(image_path, size, data)
+        return data
+    except Exception as e:
+        print(f"Image resize error: {e}")
+        return None
+
+def prewarm_thumbnails(image_dir: str = IMAGE_DIR, sizes: List[tuple] = None) -> int:
+    """
+    為 images/ 內所有圖片預先產生常用尺寸的縮圖，回傳新產生的張數。
+    """
+    sizes = sizes or THUMBNAIL_SIZES
+    valid_exts = ('.jpg', '.jpeg', '.png', '.webp')
+    created = 0
+    for root, dirs, files in os.walk(image_dir):
+        dirs[:] = [d for d in dirs if os.path.abspath(os.path.join(root, d)) != os.path.abspath(THUMB_CACHE_DIR)]
+        for filename in files:
+            if not filename.lower().endswith(valid_exts):
+                continue
+            path = os.path.join(root, filename)
+            for size in sizes:
+                if THUMBNAIL_CACHE.get(path, size) is None and resize_image_to_bytes(path, size):
+                    created += 1
+    return created
+
+def _transcode_image(source_path: str, dest_path: str) -> bool:
+    """
+    轉成最長邊不超過 IMAGE_MAX_SIDE 的 WebP；有透明度的 (去背圖) 保留 alpha。
+    """
+    Image = lazy_import('PIL.Image')
+    ImageOps = lazy_import('PIL.ImageOps')
+    img = Image.open(source_path)
+    img.draft('RGB', (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+    img = ImageOps.exif_transpose(img)
+    has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+    img = img.convert('RGBA' if has_alpha else 'RGB')
+    img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+    temp_path = f"{dest_path}.{os.getpid()}.tmp"
+    img.save(temp_path, format="WEBP", quality=IMAGE_WEBP_QUALITY, method=4)
+    os.replace(temp_path, dest_path)
+    return True
+
+def store_image(source_path: str, image_dir: str, stem: str) -> str:
+    """
+    把匯入的圖片存進衣櫃圖片資料夾，回傳存檔路徑。
+    有 Pillow 時存成縮小過的 WebP (images/<stem>.webp)，否則 (或轉檔失敗時) 照原樣複製。
+    KEEP_ORIGINAL_IMAGES 開啟時另存一份原圖。
+    """
+    import shutil
+    os.makedirs(image_dir, exist_ok=True)
+    ext = os.path.splitext(source_path)[1] or '.png'
+    if KEEP_ORIGINAL_IMAGES:
+        originals_dir = os.path.join(image_dir, os.path.relpath(ORIGINALS_DIR, IMAGE_DIR))
+        os.makedirs(originals_dir, exist_ok=True)
+        shutil.copy2(source_path, os.path.join(originals_dir, f"{stem}{ext}"))
+
+    if HAS_PIL:
+        dest_path = os.path.join(image_dir, f"{stem}.webp")
+        try:
+            _transcode_image(source_path, dest_path)
+            return dest_path
+        except Exception as e:
+            print(f"WebP transcode failed for {source_path}, keeping original: {e}")
+
+    dest_path = os.path.join(image_dir, f"{stem}{ext}")
+    shutil.copy2(source_path, dest_path)
+    return dest_path
+
+def _migrate_image_task(image_path: str) -> Optional[tuple]:
+    # 在 worker process 中執行: 回傳 (新路徑, 原大小, 新大小)，失敗回傳 None
+    dest_path = os.path.splitext(image_path)[0] + '.webp'
+    try:
+        before = os.path.getsize(image_path)
+        _transcode_image(image_path, dest_path)
+        return dest_path, before, os.path.getsize(dest_path)
+    except Exception as e:
+        print(f"Migrate image failed for {image_path}: {e}")
+        return None
+
+def migrate_image_store(wardrobe_mgr: 'WardrobeManager', workers: int = None, progress_callback=None) -> Dict[str, int]:
+    """
+    把衣櫃中既有的圖片 (非 WebP) 平行轉成縮小的 WebP，並更新單品的 image_path。
+    原檔在 KEEP_ORIGINAL_IMAGES 開啟時移到 images/originals/，否則刪除。
+    progress_callback(done, total, image_path) 回傳 False 可中止 (已完成的仍會寫入)。
+    回傳統計: converted / failed / bytes_before / bytes_after。
+    """
+    stats = {'converted': 0, 'failed': 0, 'bytes_before': 0, 'bytes_after': 0}
+    if not HAS_PIL:
+        print("Image migration requires Pillow.")
+        return stats
+
+    targets = {}
+    for item in wardrobe_mgr.items:
+        path = item.get('image_path')
+        if path and os.path.exists(path) and os.path.splitext(path)[1].lower() != '.webp':
+            targets.setdefault(path, []).append(item['id'])
+    paths = list(targets)
+    if not paths:
+        return stats
+
+    results = {}
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    # 與 remove_bg_batch 相同用 spawn: 不 fork 已載入 Tk、rembg session 且有背景執行緒的行程
+    with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 2, len(paths)),
+                             mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {pool.submit(_migrate_image_task, path): path for path in paths}
+        for done, future in enumerate(as_completed(futures), 1):
+            path = futures[future]
+            results[path] = future.result()
+            if progress_callback and progress_callback(done, len(paths), path) is False:
+                for f in futures:
+                    f.cancel()
+                break
+
+    import shutil
+    try:
+        with wardrobe_mgr.transaction():
+            for path, result in results.items():
+                if not result:
+                    stats['failed'] += 1
+                    continue
+                new_path, before, after = result
+                for iid in targets[path]:
+                    wardrobe_mgr.update_item(iid, {'image_path': new_path})
+                stats['converted'] += 1
+                stats['bytes_before'] += before
+                stats['bytes_after'] += after
+    except TransactionError:
+        return {'converted': 0, 'failed': len(paths), 'bytes_before': 0, 'bytes_after': 0}
+
+    # 資料寫入成功後才處理原檔
+    for path, result in results.items():
+        if not result:
+            continue
+        try:
+            if KEEP_ORIGINAL_IMAGES:
+                originals_dir = os.path.join(os.path.dirname(path), os.path.relpath(ORIGINALS_DIR, IMAGE_DIR))
+                os.makedirs(originals_dir, exist_ok=True)
+                shutil.move(path, os.path.join(originals_dir, os.path.basename(path)))
+            else:
+                os.remove(path)
+        except OSError as e:
+            print(f"Could not remove original {path}: {e}")
+    return stats
+
+class ImageHashIndex:
+    """
+    圖片感知雜湊 (dHash, 64 bit) 索引，用來在去背與 AI 分析之前找出近似重複的照片。
+    - files:   檔案 key (路徑|mtime|size) -> hash，圖片沒變就不必重新解碼
+    - sources: 單品 id -> 匯入時原始照片的 hash
+               (衣櫃裡存的常是去背圖，和原始照片的 hash 不同，再次匯入同一張原圖時靠這個比對)
+    """
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        self._lock = threading.Lock()
+        self._data = None
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if self._data is None:
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    self._data = json.load(f)
+            except (OSError, ValueError):
+                self._data = {}
+            self._data.setdefault('files', {})
+            self._data.setdefault('sources', {})
+        return self._data
+
+    def save(self):
+        with self._lock:
+            if self._data is None:
+                return
+            try:
+                temp_path = f"{self.index_path}.tmp"
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(self._data, f)
+                os.replace(temp_path, self.index_path)
+            except OSError as e:
+                print(f"Image hash index write error: {e}")
+
+    @staticmethod
+    def compute(image_path: str) -> Optional[int]:
+        """dHash: 縮成 9x8 灰階，比較左右相鄰像素的明暗。透明背景先鋪白底，去背圖才不會全黑。"""
+        if not HAS_PIL:
+            return None
+        Image = lazy_import('PIL.Image')
+        try:
+            img = Image.open(image_path)
+            img.draft('RGB', (64, 64))
+            if img.mode in ('RGBA', 'LA', 'P'):
+                img = img.convert('RGBA')
+                base = Image.new('RGBA', img.size, (255, 255, 255, 255))
+                img = Image.alpha_composite(base, img)
+            pixels = list(img.convert('L').resize((9, 8), Image.BILINEAR).getdata())
+        except Exception as e:
+            print(f"Image hash error ({image_path}): {e}")
+            return None
+        value = 0
+        for row in range(8):
+            for col in range(8):
+                value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+        return value
+
+    def image_hash(self, image_path: str) -> Optional[int]:
+        try:
+            st = os.stat(image_path)
+        except OSError:
+            return None
+        file_key = f"{os.path.abspath(image_path)}|{st.st_mtime_ns}|{st.st_size}"
+        with self._lock:
+            cached = self._load()['files'].get(file_key)
+        if cached:
+            return int(cached, 16)
+        value = self.compute(image_path)
+        if value is not None:
+            with self._lock:
+                self._load()['files'][file_key] = f"{value:016x}"
+        return value
+
+    def remember_source(self, item_id: str, value: Optional[int]):
+        if value is None:
+            return
+        with self._lock:
+            self._load()['sources'][item_id] = f"{value:016x}"
+
+    def item_hashes(self, item: Dict[str, Any]) -> List[int]:
+        hashes = []
+        with self._lock:
+            source = self._load()['sources'].get(item['id'])
+        if source:
+            hashes.append(int(source, 16))
+        if item.get('image_path'):
+            value = self.image_hash(item['image_path'])
+            if value is not None:
+                hashes.append(value)
+        return hashes
+
+    @staticmethod
+    def distance(a: int, b: int) -> int:
+        return bin(a ^ b).count('1')
+
+IMAGE_HASH_INDEX = ImageHashIndex(PHASH_INDEX_FILE)
+
+class HammingIndex:
+    """
+    64 bit hash 的近鄰索引 (鴿籠原理): 把 hash 切成 max_distance + 1 段，
+    相差不超過 max_distance bit 的兩個 hash 至少有一段完全相同，
+    查詢時只和同一段相同的候選算距離，不必和每個 hash 都比一次。
+    """
+    def __init__(self, max_distance: int):
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        bounds = [64 * i // bands for i in range(bands + 1)]
+        self._bands = [(lo, (1 << (hi - lo)) - 1) for lo, hi in zip(bounds, bounds[1:])]
+        self._buckets = [{} for _ in self._bands]
+
+    def add(self, owner: str, value: int):
+        for bucket, (shift, mask) in zip(self._buckets, self._bands):
+            bucket.setdefault((value >> shift) & mask, []).append((owner, value))
+
+    def neighbors(self, value: int) -> Dict[str, int]:
+        """回傳 {owner: 最小相差 bit 數}，只含相差不超過 max_distance 者。"""
+        found = {}
+        for bucket, (shift, mask) in zip(self._buckets, self._bands):
+            for owner, h in bucket.get((value >> shift) & mask, ()):
+                d = ImageHashIndex.distance(value, h)
+                if d <= self.max_distance and d < found.get(owner, 65):
+                    found[owner] = d
+        return found
+
+    def nearest(self, value: int) -> Optional[Tuple[str, int]]:
+        found = self.neighbors(value)
+        if not found:
+            return None
+        owner = min(found, key=found.get)
+        return owner, found[owner]
 
-```json
-{{
-  "ok": true,
-  "message": "給使用者的簡短建議或鼓勵",
-  "data": {{
-    "type": "衣服類型 (如: 外套, 洋裝, 襯衫)",
-    "color": "主色系",
-    "styleTags": ["標籤1", "標籤2", ...],
-    "seasons": ["季節1", ...],
-    "occasions": ["場合1", ...],
-    "lengthDesc": "長度描述...",
-    "bodyEffect": "修飾效果分析...",
-    "notes": "搭配建議..."
-  }}
-}}
-```
-"""
-    return prompt.strip()
+def _report_progress(progress_callback, done: int, total: int, label: str, every: int = 25) -> bool:
+    # 大衣櫃每件都更新畫面太慢，每 every 件 (與最後一件) 才回報一次；回傳 False 表示要中止
+    if progress_callback and (done % every == 0 or done == total):
+        return progress_callback(done, total, label) is not False
+    return True
 
-def resize_image_to_bytes(image_path: str, size: tuple) -> Optional[bytes]:
+def build_known_hashes(wardrobe_mgr: 'WardrobeManager', max_distance: int = None,
+                       progress_callback=None) -> HammingIndex:
     """
-    讀取圖片並縮放，回傳 PNG bytes 給 sg.Image 使用。
-    如果沒有安裝 Pillow 或讀取失敗，回傳 None。
+    把衣櫃所有單品的照片 hash 建成近鄰索引，一批匯入只需建一次。
+    第一次使用時要解碼每張衣櫃照片，progress_callback(done, total, label) 可用來顯示進度。
     """
-    if not HAS_PIL:
-        return None
-    
-    try:
-        if not os.path.exists(image_path):
-            return None
-            
-        img = Image.open(image_path)
-        img.thumbnail(size)
-        
-        bio = io.BytesIO()
-        img.save(bio, format="PNG")
-        return bio.getvalue()
-    except Exception as e:
-        print(f"Image resize error: {e}")
-        return None
+    max_distance = PHASH_MAX_DISTANCE if max_distance is None else max_distance
+    items = list(wardrobe_mgr.items)
+    known = HammingIndex(max_distance)
+    for n, item in enumerate(items, 1):
+        for h in IMAGE_HASH_INDEX.item_hashes(item):
+            known.add(item['id'], h)
+        if not _report_progress(progress_callback, n, len(items), item.get('image_path') or item['id']):
+            break
+    return known
+
+def check_import_duplicates(img_paths: List[str], wardrobe_mgr: 'WardrobeManager',
+                            max_distance: int = None, known: Optional[HammingIndex] = None,
+                            progress_callback=None) -> Tuple[List[Optional[int]], Dict[str, Tuple[str, int]]]:
+    """
+    計算待匯入照片的 hash，並找出和衣櫃既有單品 (或同一批前面的照片) 近似重複者。
+    回傳 (每張照片的 hash, {照片路徑: (重複對象的單品 id 或檔名, 相差 bit 數)})。
+    known: 逐張檢查時由呼叫端用 build_known_hashes 建好重複使用 (照片會加進去)，
+           並由呼叫端在整批結束後 IMAGE_HASH_INDEX.save()；沒給時這裡自己建索引並存檔。
+    """
+    own_index = known is None
+    if own_index:
+        known = build_known_hashes(wardrobe_mgr, max_distance, progress_callback)
+    hashes, duplicates = [], {}
+    for path in img_paths:
+        value = IMAGE_HASH_INDEX.image_hash(path)
+        hashes.append(value)
+        if value is None:
+            continue
+        best = known.nearest(value)
+        if best:
+            duplicates[path] = best
+        known.add(os.path.basename(path), value)
+    if own_index:
+        IMAGE_HASH_INDEX.save()
+    return hashes, duplicates
+
+def find_duplicate_items(wardrobe_mgr: 'WardrobeManager', max_distance: int = None,
+                         progress_callback=None) -> List[List[str]]:
+    """
+    找出衣櫃中照片近似重複的單品，回傳分組後的單品 id 清單 (每組至少兩件)。
+    每件只和近鄰索引裡同段相同的候選比對，不做兩兩比對。
+    """
+    max_distance = PHASH_MAX_DISTANCE if max_distance is None else max_distance
+    items = list(wardrobe_mgr.items)
+    index = HammingIndex(max_distance)
+    parent = {}
+    def root(iid):
+        while parent[iid] != iid:
+            parent[iid] = parent[parent[iid]]
+            iid = parent[iid]
+        return iid
+
+    for n, item in enumerate(items, 1):
+        iid = item['id']
+        hashes = IMAGE_HASH_INDEX.item_hashes(item)
+        if hashes:
+            parent.setdefault(iid, iid)
+        for h in hashes:
+            for other in index.neighbors(h):
+                if other != iid:
+                    parent[root(other)] = root(iid)
+        for h in hashes:
+            index.add(iid, h)
+        if not _report_progress(progress_callback, n, len(items), item.get('image_path') or iid):
+            break
+    IMAGE_HASH_INDEX.save()
+
+    groups = {}
+    for iid in parent:
+        groups.setdefault(root(iid), []).append(iid)
+    return [g for g in groups.values() if len(g) > 1]
+
+def format_duplicate_report(wardrobe_mgr: 'WardrobeManager', groups: List[List[str]]) -> str:
+    if not groups:
+        return "沒有找到重複的單品。"
+    lines = [f"找到 {len(groups)} 組可能重複的單品："]
+    for n, group in enumerate(groups, 1):
+        lines.append(f"\n[{n}]")
+        for iid in group:
+            item = wardrobe_mgr.get(iid) or {}
+            lines.append(f"  {iid}  {item.get('name', '')}  ({item.get('purchase_date', '')})")
+    return "\n".join(lines)
 
 def get_category(item_type: str) -> str:
     """
@@ -723,31 +2700,278 @@ def get_unique_categories(items: List[Dict[str, Any]]) -> List[str]:
     sorted_cats = sorted(list(categories))
     return ['全部'] + sorted_cats
 
-def build_ootd_prompt(profile: Dict[str, Any], wardrobe_items: List[Dict[str, Any]], context: Dict[str, str]) -> str:
+def estimate_tokens(text: str) -> int:
+    """粗估 token 數: 英數約 4 個字元一個 token，中日韓文字約一字一個 token。"""
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars)
+
+SEASON_KEYWORDS = {
+    '春': ['春', '溫暖', '暖和', '舒適', 'spring', 'mild'],
+    '夏': ['夏', '熱', '炎', '悶', '曬', '高溫', 'summer', 'hot', 'sunny'],
+    '秋': ['秋', '涼', '微冷', 'autumn', 'fall', 'cool'],
+    '冬': ['冬', '冷', '寒', '雪', '低溫', 'winter', 'cold', 'snow'],
+}
+# 整個詞比對 (不分大小寫)，不用子字串: 否則 'fall' 會因為含有 'all' 被當成四季皆宜
+ALL_SEASON_WORDS = ('四季', '四季皆宜', '四季適用', '全年', '全年適用', 'all', 'all-season', 'all-year', 'year-round')
+
+def _as_list(value) -> List[str]:
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [v for v in re.split(r'[,、/ ]+', value) if v]
+    return [str(v) for v in value]
+
+def _is_all_season(values) -> bool:
+    return any(v.strip().lower() in ALL_SEASON_WORDS for v in values)
+
+def infer_seasons(weather: str) -> set:
     """
-    產生「OOTD 穿搭建議」用的 Prompt。
+    從天氣描述推測季節: 關鍵字 (熱、冷、涼...) 或溫度 (例如 28度、15°C)。推不出來回傳空集合。
+    """
+    text = (weather or '').lower()
+    seasons = {season for season, words in SEASON_KEYWORDS.items() if any(w in text for w in words)}
+    m = re.search(r'(-?\d+(?:\.\d+)?)\s*(?:度|°|℃|c\b)', text)
+    if m:
+        temp = float(m.group(1))
+        seasons |= {'夏'} if temp >= 26 else {'春', '秋'} if temp >= 17 else {'冬'}
+    return seasons
+
+def score_item_for_context(item: Dict[str, Any], seasons: set, context: Dict[str, str]) -> float:
+    """
+    單品與今天情境的契合度: 季節相符 +2 (明確不符 -3)、場合相符 +2、風格標籤與心情相符各 +1。
+    """
+    ai_data = item.get('ai', {}) or {}
+    score = 0.0
+    item_seasons = _as_list(ai_data.get('seasons'))
+    if seasons and item_seasons:
+        if _is_all_season(item_seasons) or any(s in seasons for s in item_seasons):
+            score += 2
+        else:
+            score -= 3
+    occasion_text = context.get('occasion', '') or ''
+    if any(o and (o in occasion_text or occasion_text in o) for o in _as_list(ai_data.get('occasions')) if occasion_text):
+        score += 2
+    mood_text = f"{context.get('mood', '')} {occasion_text}"
+    score += sum(1 for tag in _as_list(ai_data.get('styleTags')) if tag and tag in mood_text)
+    return score
+
+def prefilter_ootd_candidates(wardrobe_items: List[Dict[str, Any]], context: Dict[str, str],
+                              top_k: int = None) -> List[Dict[str, Any]]:
     """
-    # 簡化衣櫃資料，減少 Token 消耗
-    # 只包含狀態為 'available' 的衣服
-    simple_wardrobe = []
+    縮小送進 OOTD prompt 的候選單品:
+    1. 只留 'available' 的衣服
+    2. 季節明確不符的先剔除 (若整個分類都被剔除，保留該分類分數最高的一件，避免缺上衣/鞋子)
+    3. 每個分類依契合度 (同分時穿著次數少的優先) 只留前 top_k 件
+    """
+    top_k = top_k or OOTD_PREFILTER_TOP_K
+    seasons = infer_seasons(context.get('weather', ''))
+    buckets = {}
     for item in wardrobe_items:
-        # 過濾掉不在衣櫃的衣服
         if item.get('status', 'available') != 'available':
             continue
-            
-        ai_data = item.get('ai', {})
-        simple_wardrobe.append({
-            "id": item.get('id'),
-            "name": item.get('name'),
-            "type": ai_data.get('type'),
-            "color": ai_data.get('color'),
-            "styleTags": ai_data.get('styleTags'),
-            "seasons": ai_data.get('seasons'),
-            "occasions": ai_data.get('occasions')
+        category = get_category((item.get('ai', {}) or {}).get('type', '') or '')
+        buckets.setdefault(category, []).append((score_item_for_context(item, seasons, context), item))
+
+    candidates = []
+    for category, scored in buckets.items():
+        scored.sort(key=lambda x: (-x[0], x[1].get('wear_count', 0) or 0))
+        kept = [entry for entry in scored if entry[0] >= 0] or scored[:1]
+        candidates.extend(item for _, item in kept[:top_k])
+    return candidates
+
+NEUTRAL_COLOR_WORDS = ('黑', '白', '灰', '米', '卡其', '駝', '杏', '大地', '丹寧', '牛仔', '深藍', '海軍',
+                       'black', 'white', 'grey', 'gray', 'beige', 'khaki', 'navy', 'denim', 'cream')
+
+def _pair_harmony(a: Dict[str, Any], b: Dict[str, Any]) -> float:
+    """
+    兩件單品搭在一起的協調度: 中性色好搭、同色系加分、兩個不同的亮色扣分；
+    共同的風格標籤、場合加分；季節完全不重疊扣分。
+    """
+    ai_a, ai_b = a.get('ai', {}) or {}, b.get('ai', {}) or {}
+    score = 0.0
+    color_a, color_b = (ai_a.get('color') or '').lower(), (ai_b.get('color') or '').lower()
+    if color_a and color_b:
+        neutral_a = any(w in color_a for w in NEUTRAL_COLOR_WORDS)
+        neutral_b = any(w in color_b for w in NEUTRAL_COLOR_WORDS)
+        if neutral_a or neutral_b:
+            score += 1
+        elif color_a[:1] == color_b[:1]:
+            score += 0.5
+        else:
+            score -= 0.5
+    score += 0.5 * len(set(_as_list(ai_a.get('styleTags'))) & set(_as_list(ai_b.get('styleTags'))))
+    score += 0.5 * len(set(_as_list(ai_a.get('occasions'))) & set(_as_list(ai_b.get('occasions'))))
+    seasons_a, seasons_b = set(_as_list(ai_a.get('seasons'))), set(_as_list(ai_b.get('seasons')))
+    if seasons_a and seasons_b and not (seasons_a & seasons_b) \
+            and not _is_all_season(seasons_a | seasons_b):
+        score -= 1
+    return score
+
+def _outfit_score(items: List[Dict[str, Any]], item_scores: Dict[str, float], harmony_cache: Dict[tuple, float]) -> float:
+    # 單品契合度與兩兩協調度都取平均，件數多的組合 (上身+下身) 不會因此佔便宜
+    harmony = []
+    for i, a in enumerate(items):
+        for b in items[i + 1:]:
+            key = (a['id'], b['id'])
+            if key not in harmony_cache:
+                harmony_cache[key] = _pair_harmony(a, b)
+            harmony.append(harmony_cache[key])
+    score = sum(item_scores[item['id']] for item in items) / len(items)
+    score += sum(harmony) / len(harmony) if harmony else 0
+    # 同分時優先推薦比較少穿的
+    score -= 0.01 * sum(item.get('wear_count', 0) or 0 for item in items) / len(items)
+    return score
+
+def _describe_outfit(items: List[Dict[str, Any]], seasons: set, context: Dict[str, str]) -> str:
+    reasons = []
+    if seasons:
+        reasons.append(f"適合{'/'.join(sorted(seasons))}季的天氣")
+    occasion = context.get('occasion', '') or ''
+    if occasion and any(o in occasion or occasion in o for item in items for o in _as_list((item.get('ai') or {}).get('occasions'))):
+        reasons.append(f"適合{occasion}")
+    tags = {}
+    for item in items:
+        for tag in _as_list((item.get('ai') or {}).get('styleTags')):
+            tags[tag] = tags.get(tag, 0) + 1
+    shared = [t for t, n in sorted(tags.items(), key=lambda x: -x[1]) if n > 1][:3]
+    if shared:
+        reasons.append(f"風格統一 ({'、'.join(shared)})")
+    colors = [c for c in ((item.get('ai') or {}).get('color') for item in items) if c]
+    if colors:
+        reasons.append(f"配色: {' + '.join(colors)}")
+    return '；'.join(reasons) or '依衣櫃現有單品組合的基本搭配。'
+
+def suggest_outfits(wardrobe_items: List[Dict[str, Any]], context: Dict[str, str], top_n: int = None,
+                    pool_size: int = None) -> List[Dict[str, Any]]:
+    """
+    本機穿搭推薦: 依 get_category 分類組出合理的骨架 (上身+下身+鞋、或洋裝+鞋，
+    冬季或加分時再加外套 (熱天不加)，配件可選)，以季節、場合、風格標籤、顏色評分，回傳前 top_n 套。
+    回傳格式與 AI 回應的 outfits 相同 (title / reason / itemIds / notes)，另附 score。
+    """
+    import itertools
+    top_n = top_n or OOTD_LOCAL_TOP_N
+    pool_size = pool_size or OOTD_LOCAL_POOL_SIZE
+    seasons = infer_seasons(context.get('weather', ''))
+
+    pools = {}
+    item_scores = {}
+    harmony_cache = {}
+    for item in prefilter_ootd_candidates(wardrobe_items, context, top_k=pool_size):
+        category = get_category((item.get('ai', {}) or {}).get('type', '') or '')
+        pools.setdefault(category, []).append(item)
+        item_scores[item['id']] = score_item_for_context(item, seasons, context)
+
+    shoes = pools.get('鞋靴') or [None]
+    cores = [[top, bottom] for top in pools.get('上身', []) for bottom in pools.get('下身', [])]
+    cores += [[dress] for dress in pools.get('洋裝', [])]
+
+    # 只有推得出冬季 (冷、寒或低於 17 度) 才強制加外套；17~25 度推出的春/秋讓外套自己憑分數決定
+    cold = '冬' in seasons and '夏' not in seasons
+    hot = seasons == {'夏'}
+    candidates = []
+    for core, shoe in itertools.product(cores, shoes):
+        base = core + ([shoe] if shoe else [])
+        best, best_score = base, _outfit_score(base, item_scores, harmony_cache)
+        # 外套、配件: 各挑一件最加分的 (冬季一定加外套)
+        for optional in ('外套', '配件'):
+            if optional == '外套' and hot:
+                continue
+            options = [(_outfit_score(best + [extra], item_scores, harmony_cache), extra) for extra in pools.get(optional, [])]
+            if not options:
+                continue
+            extra_score, extra = max(options, key=lambda x: x[0])
+            if extra_score > best_score or (optional == '外套' and cold):
+                best, best_score = best + [extra], extra_score
+        candidates.append((best_score, best, core))
+
+    candidates.sort(key=lambda x: -x[0])
+    outfits, used, used_cores = [], [], set()
+    for score, items, core in candidates:
+        # 避免前幾名只差一件鞋子或配件: 主體相同、或和已選的任一套重複超過一半的單品就跳過
+        ids = {item['id'] for item in items}
+        core_key = frozenset(item['id'] for item in core)
+        if core_key in used_cores or any(len(ids & chosen) * 2 > len(ids) for chosen in used):
+            continue
+        used.append(ids)
+        used_cores.add(core_key)
+        outfits.append({
+            "title": ' × '.join(item.get('name', '') for item in core),
+            "reason": _describe_outfit(items, seasons, context),
+            "itemIds": [item['id'] for item in items],
+            "notes": "本機評分推薦",
+            "score": round(score, 2)
         })
-    
-    wardrobe_json = json.dumps(simple_wardrobe, ensure_ascii=False, indent=2)
+        if len(outfits) >= top_n:
+            break
+    return outfits
+
+def _ootd_wardrobe_entry(item: Dict[str, Any]) -> Dict[str, Any]:
+    ai_data = item.get('ai', {}) or {}
+    entry = {
+        "id": item.get('id'),
+        "name": item.get('name'),
+        "type": ai_data.get('type'),
+        "color": ai_data.get('color'),
+        "styleTags": ai_data.get('styleTags'),
+        "seasons": ai_data.get('seasons'),
+        "occasions": ai_data.get('occasions')
+    }
+    return {k: v for k, v in entry.items() if v not in (None, '', [])}
+
+def build_ootd_prompt(profile: Dict[str, Any], wardrobe_items: List[Dict[str, Any]], context: Dict[str, str],
+                      prefilter: bool = True, token_budget: int = None, stats: Optional[Dict[str, int]] = None,
+                      shortlist: Optional[List[Dict[str, Any]]] = None) -> str:
+    """
+    產生「OOTD 穿搭建議」用的 Prompt。
+    prefilter=True 時先以 prefilter_ootd_candidates 縮小候選單品，
+    並逐步降低每個分類的件數，直到預估 token 數不超過 token_budget。
+    stats: 若有傳入，填入篩選前後的單品數與預估 token 數。
+    shortlist: suggest_outfits 的本機推薦，列在 prompt 中供 AI 參考 (其中的單品一定保留在候選中)。
+    """
+    token_budget = token_budget or OOTD_PROMPT_TOKEN_BUDGET
+    available = [item for item in wardrobe_items if item.get('status', 'available') == 'available']
+
+    if not prefilter:
+        prompt = _render_ootd_prompt(profile, available, context, shortlist)
+        if stats is not None:
+            tokens = estimate_tokens(prompt)
+            stats.update(items_before=len(available), items_after=len(available), tokens_before=tokens, tokens_after=tokens)
+        return prompt
+
+    top_k = OOTD_PREFILTER_TOP_K
+    while True:
+        candidates = prefilter_ootd_candidates(available, context, top_k=top_k)
+        if shortlist:
+            kept = {item['id'] for item in candidates}
+            shortlist_ids = {iid for outfit in shortlist for iid in outfit.get('itemIds', [])}
+            candidates += [item for item in available if item['id'] in shortlist_ids and item['id'] not in kept]
+        prompt = _render_ootd_prompt(profile, candidates, context, shortlist)
+        tokens = estimate_tokens(prompt)
+        if tokens <= token_budget or top_k <= 1:
+            break
+        top_k -= 1
+
+    if stats is not None:
+        stats.update(items_before=len(available), items_after=len(candidates),
+                     tokens_before=estimate_tokens(_render_ootd_prompt(profile, available, context, shortlist)),
+                     tokens_after=tokens)
+        print(f"OOTD prompt: {stats['items_before']} -> {stats['items_after']} items, "
+              f"~{stats['tokens_before']} -> ~{stats['tokens_after']} tokens (top {top_k} per category)")
+    return prompt
+
+def _render_ootd_prompt(profile: Dict[str, Any], items: List[Dict[str, Any]], context: Dict[str, str],
+                        shortlist: Optional[List[Dict[str, Any]]] = None) -> str:
+    # 衣櫃每件一行 (不縮排)，減少 Token 消耗
+    wardrobe_json = "[\n" + ",\n".join(json.dumps(_ootd_wardrobe_entry(item), ensure_ascii=False, separators=(',', ':'))
+                                        for item in items) + "\n]"
     profile_json = json.dumps(profile, ensure_ascii=False, indent=2)
+    shortlist_section = ''
+    if shortlist:
+        lines = "\n".join(f"- {', '.join(o['itemIds'])} ({o['reason']})" for o in shortlist)
+        shortlist_section = f"""
+### 3.1 系統初步篩選的候選搭配 (可參考，也可自行調整)
+{lines}
+"""
 
     prompt = f"""
 你是一位頂尖的時尚穿搭顧問。
@@ -768,7 +2992,7 @@ def build_ootd_prompt(profile: Dict[str, Any], wardrobe_items: List[Dict[str, An
 ```json
 {wardrobe_json}
 ```
-
+{shortlist_section}
 ---
 ### 4. 你的任務
 請從衣櫃中挑選適合的單品組合成一套穿搭。
@@ -799,51 +3023,77 @@ def build_ootd_prompt(profile: Dict[str, Any], wardrobe_items: List[Dict[str, An
 """
     return prompt.strip()
 
-def export_ootd_zip(outfit: Dict[str, Any], wardrobe_mgr: WardrobeManager, profile_mgr: UserProfileManager):
+def _export_image_bytes(image_path: str, max_size: tuple) -> Optional[tuple]:
     """
-    將 OOTD 結果匯出為 ZIP 檔
-    包含:
-    1. 全身照 (user_body.png)
-    2. 單品圖片 (item_id.png)
-    3. 穿搭資訊 (info.txt)
+    匯出用的縮小圖片，回傳 (bytes, 副檔名)。有透明度的去背圖存 PNG，其餘存 JPEG。
+    無法處理時回傳 None (呼叫端改放原圖)。
     """
-    save_path = sg.popup_get_file('匯出 OOTD', save_as=True, file_types=(('ZIP Files', '*.zip'),), default_extension='.zip')
-    if not save_path:
-        return
-
-    # 檢查是否有全身照
-    body_photo_path = profile_mgr.data.get('body_photo_path')
-    if not body_photo_path or not os.path.exists(body_photo_path):
-        sg.popup_error('無法匯出：請先至「個人資料」分頁上傳全身照！\n這是生成試穿圖的必要條件。')
-        return
+    if not HAS_PIL:
+        return None
+    try:
+        img = lazy_import('PIL.Image').open(image_path)
+        img.draft('RGB', max_size)
+        img = lazy_import('PIL.ImageOps').exif_transpose(img) # 重新編碼會丟掉 EXIF，先轉正
+        img.thumbnail(max_size)
+        bio = io.BytesIO()
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img.save(bio, format="PNG", optimize=True)
+            return bio.getvalue(), '.png'
+        img.convert('RGB').save(bio, format="JPEG", quality=EXPORT_JPEG_QUALITY)
+        return bio.getvalue(), '.jpg'
+    except Exception as e:
+        print(f"Export resize error ({image_path}): {e}")
+        return None
 
-    import tempfile
-    import shutil
+def write_ootd_zip(save_path: str, outfit: Dict[str, Any], wardrobe_mgr: WardrobeManager,
+                   profile_mgr: UserProfileManager, image_size: Optional[tuple] = None):
+    """
+    把 OOTD 直接寫進 ZIP (不經暫存資料夾)。
+    圖片本身已壓縮過，用 ZIP_STORED 存放；文字檔才用 ZIP_DEFLATED。
+    image_size: 指定時放入縮小後的圖片，而不是原圖。
+    """
     import zipfile
 
+    def add_image(zipf, src_path: str, stem: str) -> str:
+        if image_size:
+            resized = _export_image_bytes(src_path, image_size)
+            if resized:
+                data, ext = resized
+                zipf.writestr(f"{stem}{ext}", data, compress_type=zipfile.ZIP_STORED)
+                return f"{stem}{ext}"
+        ext = os.path.splitext(src_path)[1]
+        zipf.write(src_path, f"{stem}{ext}", compress_type=zipfile.ZIP_STORED)
+        return f"{stem}{ext}"
+
     try:
-        # 建立暫存資料夾
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # 1. 複製全身照
+        with zipfile.ZipFile(save_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            # 1. 全身照
             body_photo_path = profile_mgr.data.get('body_photo_path')
+            body_name = 'body.png'
             if body_photo_path and os.path.exists(body_photo_path):
-                ext = os.path.splitext(body_photo_path)[1]
-                shutil.copy2(body_photo_path, os.path.join(temp_dir, f"body{ext}"))
+                body_name = add_image(zipf, body_photo_path, 'body')
 
-            # 2. 複製單品圖片
+            # 2. 單品圖片 (檔名: 1_單品名稱.png，避免檔名衝突)
             item_ids = outfit.get('itemIds', [])
             item_names = []
+            prompt_lines = []
             for i, iid in enumerate(item_ids):
-                item = next((x for x in wardrobe_mgr.items if x['id'] == iid), None)
-                if item:
-                    item_names.append(f"{i+1}. {item['name']}")
-                    if item.get('image_path') and os.path.exists(item['image_path']):
-                        ext = os.path.splitext(item['image_path'])[1]
-                        # 檔名: 1_單品名稱.png (避免檔名衝突與亂碼，可考慮用 ID)
-                        safe_name = "".join([c for c in item['name'] if c.isalnum() or c in ('-', '_')])
-                        shutil.copy2(item['image_path'], os.path.join(temp_dir, f"{i+1}_{safe_name}{ext}"))
-
-            # 3. 建立資訊文字檔
+                item = wardrobe_mgr.get(iid)
+                if not item:
+                    prompt_lines.append(f"{i+1}. [Missing Item Data] (ID: {iid}) - Image: N/A")
+                    continue
+                item_names.append(f"{i+1}. {item['name']}")
+                safe_name = "".join([c for c in item['name'] if c.isalnum() or c in ('-', '_')])
+                stem = f"{i+1}_{safe_name}"
+                if item.get('image_path') and os.path.exists(item['image_path']):
+                    filename = add_image(zipf, item['image_path'], stem)
+                else:
+                    filename = stem + (os.path.splitext(item.get('image_path', ''))[1] or '.png')
+                ai_data = item.get('ai', {})
+                item_name = item.get('name', 'Unknown Item')
+                prompt_lines.append(f"{i+1}. {item_name} (Type: {ai_data.get('type', 'Unknown')}, Color: {ai_data.get('color', 'Unknown')}) - Image: {filename}")
+
+            # 3. 穿搭資訊文字檔
             info_content = f"""
 OOTD 穿搭建議
 ================================
@@ -859,46 +3109,46 @@ OOTD 穿搭建議
 單品清單:
 {chr(10).join(item_names)}
 """
-            with open(os.path.join(temp_dir, 'ootd_info.txt'), 'w', encoding='utf-8') as f:
-                f.write(info_content.strip())
+            zipf.writestr('ootd_info.txt', info_content.strip())
 
-            # 4. 建立 Virtual Try-On Prompt (prompt.txt)
-            prompt_content = "Please generate a high-quality, realistic image of the person in 'body.png' wearing the following items:\n\n"
-            
-            for i, iid in enumerate(item_ids):
-                item = next((x for x in wardrobe_mgr.items if x['id'] == iid), None)
-                if item:
-                    safe_name = "".join([c for c in item['name'] if c.isalnum() or c in ('-', '_')])
-                    ext = os.path.splitext(item.get('image_path', ''))[1]
-                    if not ext: ext = '.png'
-                    filename = f"{i+1}_{safe_name}{ext}"
-                    
-                    ai_data = item.get('ai', {})
-                    item_name = item.get('name', 'Unknown Item')
-                    prompt_content += f"{i+1}. {item_name} (Type: {ai_data.get('type', 'Unknown')}, Color: {ai_data.get('color', 'Unknown')}) - Image: {filename}\n"
-                else:
-                    prompt_content += f"{i+1}. [Missing Item Data] (ID: {iid}) - Image: N/A\n"
-            
+            # 4. Virtual Try-On Prompt (prompt.txt)
+            prompt_content = f"Please generate a high-quality, realistic image of the person in '{body_name}' wearing the following items:\n\n"
+            prompt_content += "".join(line + "\n" for line in prompt_lines)
             prompt_content += "\nTarget: A full-body shot of the person wearing these items. Maintain the person's original pose, body shape, and facial features.\n"
             prompt_content += "Important: Ensure the ENTIRE body is visible from HEAD to TOE. Do not crop the feet or shoes.\n"
             prompt_content += "Style: Photorealistic, High Definition."
-            
-            # Debug: Check item count
+            zipf.writestr('prompt.txt', prompt_content)
+
             print(f"Exporting OOTD: {len(item_ids)} items in list.")
-            
-            with open(os.path.join(temp_dir, 'prompt.txt'), 'w', encoding='utf-8') as f:
-                f.write(prompt_content)
+    except Exception:
+        # 不留下寫到一半的 ZIP
+        with contextlib.suppress(OSError):
+            os.remove(save_path)
+        raise
+
+def export_ootd_zip(outfit: Dict[str, Any], wardrobe_mgr: WardrobeManager, profile_mgr: UserProfileManager,
+                    image_size: Optional[tuple] = None):
+    """
+    將 OOTD 結果匯出為 ZIP 檔
+    包含:
+    1. 全身照 (body.png)
+    2. 單品圖片 (1_單品名稱.png)
+    3. 穿搭資訊 (ootd_info.txt) 與試穿 Prompt (prompt.txt)
+    image_size: 指定時放入縮小後的圖片 (檔案較小、匯出較快)
+    """
+    save_path = sg.popup_get_file('匯出 OOTD', save_as=True, file_types=(('ZIP Files', '*.zip'),), default_extension='.zip')
+    if not save_path:
+        return
 
-            # 5. 壓縮 (使用 zipfile 直接控制，避免 shutil 自動加副檔名問題)
-            with zipfile.ZipFile(save_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for root, dirs, files in os.walk(temp_dir):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        arcname = os.path.relpath(file_path, temp_dir)
-                        zipf.write(file_path, arcname)
-            
-            sg.popup(f'匯出成功！\n檔案已儲存至: {save_path}\n包含 prompt.txt 供 AI 試穿使用。')
+    # 檢查是否有全身照
+    body_photo_path = profile_mgr.data.get('body_photo_path')
+    if not body_photo_path or not os.path.exists(body_photo_path):
+        sg.popup_error('無法匯出：請先至「個人資料」分頁上傳全身照！\n這是生成試穿圖的必要條件。')
+        return
 
+    try:
+        write_ootd_zip(save_path, outfit, wardrobe_mgr, profile_mgr, image_size=image_size)
+        sg.popup(f'匯出成功！\n檔案已儲存至: {save_path}\n包含 prompt.txt 供 AI 試穿使用。')
     except Exception as e:
         sg.popup_error(f'匯出失敗: {e}')
 
@@ -1036,23 +3286,23 @@ def show_ootd_result_window(outfit: Dict[str, Any], wardrobe_mgr: WardrobeManage
     """
     顯示華麗的 OOTD 結果視窗，包含圖片與放大功能
     """
-    # 準備單品資料與圖片
+    # 準備單品資料 (圖片先放空白佔位，視窗開啟後由背景執行緒載入)
     item_ids = outfit.get('itemIds', [])
     items_ui = []
+    image_jobs = [] # (iid, image_path)
     
     for iid in item_ids:
-        item = next((x for x in wardrobe_mgr.items if x['id'] == iid), None)
+        item = wardrobe_mgr.get(iid)
         if item:
-            # 圖片處理
-            img_data = None
-            if HAS_PIL and item.get('image_path') and os.path.exists(item['image_path']):
-                img_data = resize_image_to_bytes(item['image_path'], (200, 200)) # 加大縮圖
+            has_image = HAS_PIL and item.get('image_path') and os.path.exists(item['image_path'])
+            if has_image:
+                image_jobs.append((iid, item['image_path']))
             
             # 單品卡片 Layout
             # 使用 Column 模擬卡片
             # 注意: sg.Image 的 enable_events=True 有時在 Column 內會被吃掉，改用 bind
             img_key = f'-IMG-{iid}-'
-            img_elem = sg.Image(data=img_data, size=(200, 200), background_color='#2C2C2C', key=img_key, enable_events=True, tooltip='點擊放大') if img_data else sg.Text('無圖片', size=(20,10), justification='center', background_color='#2C2C2C')
+            img_elem = sg.Image(data=None, size=(200, 200), background_color='#2C2C2C', key=img_key, enable_events=True, tooltip='點擊放大') if has_image else sg.Text('無圖片', size=(20,10), justification='center', background_color='#2C2C2C')
             
             card_col = sg.Column([
                 [img_elem],
@@ -1081,6 +3331,7 @@ def show_ootd_result_window(outfit: Dict[str, Any], wardrobe_mgr: WardrobeManage
         [card_frame(' 📝 穿搭筆記 ', [[sg.Multiline(outfit.get('notes', ''), size=(90, 4), font=('Segoe UI', 12), disabled=True, background_color='#1E1E1E', text_color='#E0E0E0', border_width=0)]])],
         
         [sg.Button('📦 匯出 ZIP', key='-EXPORT-ZIP-', font=FONT_HEADER, size=(15,1), button_color=('white', '#1565C0'), border_width=0, pad=((0,0), (20, 20))),
+         sg.Checkbox('縮小圖片', key='-EXPORT-RESIZE-', default=EXPORT_RESIZE_DEFAULT, font=FONT_NORMAL, background_color='#121212', pad=((10,0), (20, 20))),
          sg.Button('關閉', key='-CLOSE-', font=FONT_HEADER, size=(15,1), button_color=('white', '#424242'), border_width=0, pad=((10,0), (20, 20)))]
     ]
 
@@ -1095,14 +3346,50 @@ def show_ootd_result_window(outfit: Dict[str, Any], wardrobe_mgr: WardrobeManage
         if win[f'-IMG-{iid}-']:
             win[f'-IMG-{iid}-'].bind('<Button-1>', '')
 
+    # 背景載入: 先解碼所有卡片縮圖 (逐張送回視窗)，再預先準備 800px 放大圖
+    zoom_cache = {} # iid -> 800px PNG bytes
+    closed = threading.Event()
+    post_lock = threading.Lock() # 檢查 closed 與送出事件要一起做，關窗前先拿這把鎖
+
+    def _load_images():
+        for iid, path in image_jobs:
+            if closed.is_set():
+                return
+            data = resize_image_to_bytes(path, (200, 200))
+            if not data:
+                continue
+            with post_lock:
+                if closed.is_set():
+                    return
+                try:
+                    win.write_event_value('-OOTD-THUMB-', (iid, data))
+                except Exception:
+                    # 使用者按 X 時視窗已被 Tk 銷毀，剩下的縮圖不必送了
+                    return
+        for iid, path in image_jobs:
+            if closed.is_set():
+                return
+            zoom_cache[iid] = resize_image_to_bytes(path, (800, 800))
+
+    loader = None
+    if image_jobs:
+        loader = threading.Thread(target=_load_images, daemon=True)
+        loader.start()
+
     while True:
         event, values = win.read()
         if event in (sg.WIN_CLOSED, '-CLOSE-'):
             break
+
+        if event == '-OOTD-THUMB-':
+            iid, data = values[event]
+            win[f'-IMG-{iid}-'].update(data=data, size=(200, 200))
+            continue
             
         if event == '-EXPORT-ZIP-':
             if profile_mgr:
-                export_ootd_zip(outfit, wardrobe_mgr, profile_mgr)
+                export_ootd_zip(outfit, wardrobe_mgr, profile_mgr,
+                                image_size=EXPORT_IMAGE_SIZE if values.get('-EXPORT-RESIZE-') else None)
             else:
                 sg.popup_error('無法匯出：缺少 Profile Manager 參照。') 
             
@@ -1118,9 +3405,9 @@ def show_ootd_result_window(outfit: Dict[str, Any], wardrobe_mgr: WardrobeManage
                     iid = parts[2]
                     
                     # 找出圖片路徑
-                    item = next((x for x in wardrobe_mgr.items if x['id'] == iid), None)
+                    item = wardrobe_mgr.get(iid)
                     if item and item.get('image_path') and os.path.exists(item['image_path']):
-                        large_bytes = resize_image_to_bytes(item['image_path'], (800, 800))
+                        large_bytes = zoom_cache.get(iid) or resize_image_to_bytes(item['image_path'], (800, 800))
                         if large_bytes:
                             sg.Window(f"檢視單品: {item['name']}", 
                                       [[sg.Image(data=large_bytes)], [sg.Button('關閉')]], 
@@ -1128,73 +3415,112 @@ def show_ootd_result_window(outfit: Dict[str, Any], wardrobe_mgr: WardrobeManage
             except:
                 pass
     
+    with post_lock:
+        closed.set()
+    if loader:
+        loader.join(timeout=2) # 最多等目前這張圖處理完
     win.close()
 
-def process_batch_import(folder_path, wardrobe_mgr, profile_mgr, progress_window, api_key):
+def process_batch_import(folder_path, wardrobe_mgr, profile_mgr, progress_window, api_key, report: Optional[List[str]] = None):
     """
     批次匯入處理邏輯
+    report: 若有傳入，近似重複的照片 (略過或標示) 與分析/存檔失敗的項目會逐行記錄在這裡
     """
     valid_exts = ('.jpg', '.jpeg', '.png')
     files = [f for f in os.listdir(folder_path) if f.lower().endswith(valid_exts) and '_nobg' not in f]
-    total = len(files)
     success_count = 0
     
+    # 0. 近似重複檢查 (在去背與 AI 分析之前)
+    img_paths = [os.path.join(folder_path, f) for f in files]
+    if IMPORT_DUPLICATE_POLICY != 'off':
+        src_hashes, duplicates = check_import_duplicates(
+            img_paths, wardrobe_mgr, progress_callback=make_progress_callback(progress_window, '正在比對重複照片'))
+    else:
+        src_hashes, duplicates = [None] * len(files), {}
+    for path, (owner, dist) in duplicates.items():
+        action = '略過' if IMPORT_DUPLICATE_POLICY == 'skip' else '標示'
+        if report is not None:
+            report.append(f"{os.path.basename(path)} ≈ {owner} (差 {dist} bit，{action})")
+    if IMPORT_DUPLICATE_POLICY == 'skip' and duplicates:
+        keep = [i for i, path in enumerate(img_paths) if path not in duplicates]
+        files = [files[i] for i in keep]
+        img_paths = [img_paths[i] for i in keep]
+        src_hashes = [src_hashes[i] for i in keep]
+    total = len(files)
+    # 每個階段結束都檢查: 使用者關掉進度視窗後，後面的去背與 (要付費的) AI 分析都不再執行
+    if progress_window.was_closed():
+        return success_count
+    
+    # 1. 去背 (多個 process 平行處理)
+    nobg_paths = remove_bg_batch(img_paths, progress_callback=make_progress_callback(progress_window, '正在去背'))
+    if progress_window.was_closed():
+        return success_count
+    
+    # 2. AI 分析 (多張圖片打包成一個請求，平行送出，受同時請求數與速率限制；429 / 5xx 自動重試)
+    final_paths = [nobg if nobg else path for path, nobg in zip(img_paths, nobg_paths)]
+    item_infos = [{'name': os.path.splitext(f)[0], 'size': 'F', 'notes': 'Batch Import'} for f in files]
+    jobs = [(build_add_item_prompt(profile_mgr.data, info), path) for info, path in zip(item_infos, final_paths)]
+    analyses = analyze_batched(final_paths, profile_mgr.data, api_key, jobs,
+                               progress_callback=make_progress_callback(progress_window, 'AI 分析中'),
+                               should_cancel=progress_window.was_closed)
+    if progress_window.was_closed():
+        return success_count
+    
+    # 3. 存檔
     for i, filename in enumerate(files):
         if progress_window.was_closed():
             break
             
-        img_path = os.path.join(folder_path, filename)
+        img_path = img_paths[i]
+        final_img_path = final_paths[i]
+        item_info = item_infos[i]
         progress_window['-PROG-BAR-'].update(current_count=i+1, max=total)
-        progress_window['-PROG-TXT-'].update(f'正在處理 ({i+1}/{total}): {filename}')
+        progress_window['-PROG-TXT-'].update(f'正在存檔 ({i+1}/{total}): {filename}')
         progress_window.refresh()
         
-        # 1. 去背
-        nobg_path = remove_bg_silent(img_path)
-        final_img_path = nobg_path if nobg_path else img_path
-        
-        # 2. AI 分析
-        # 為了省錢/省時，這裡可以簡化 prompt 或只傳圖片
-        item_info = {'name': os.path.splitext(filename)[0], 'size': 'F', 'notes': 'Batch Import'}
-        prompt = build_add_item_prompt(profile_mgr.data, item_info)
+        result = analyses[i]
+        parsed = extract_json(result['text']) if result['text'] else None
+        if not (isinstance(parsed, dict) and 'data' in parsed):
+            error = result['error'] or 'AI 回傳格式無法解析'
+            print(f"Batch analysis failed for {filename}: {error}")
+            if report is not None:
+                report.append(f"{filename}: 分析失敗 ({error})")
+            continue
         
-        # 呼叫 API (若無 key 則用 Mock)
-        json_resp = call_ai_api(prompt, final_img_path, api_key)
+        ai_data = parsed['data']
+        new_id = wardrobe_mgr.generate_id(ai_data.get('type', 'unknown'))
         
-        if json_resp:
-            parsed = extract_json(json_resp)
-            if parsed and 'data' in parsed:
-                ai_data = parsed['data']
-                new_id = wardrobe_mgr.generate_id(ai_data.get('type', 'unknown'))
-                
-                # 複製圖片到 images/
-                try:
-                    script_dir = os.path.dirname(os.path.abspath(__file__))
-                    abs_image_dir = os.path.join(script_dir, IMAGE_DIR)
-                    ext = os.path.splitext(final_img_path)[1]
-                    safe_id = "".join([c for c in new_id if c.isalnum() or c in ('-', '_')])
-                    saved_img_path = os.path.join(abs_image_dir, f"{safe_id}{ext}")
-                    
-                    import shutil
-                    shutil.copy2(final_img_path, saved_img_path)
-                    
-                    new_item = {
-                        "id": new_id,
-                        "name": item_info['name'],
-                        "size": item_info['size'],
-                        "price": 0,
-                        "currency": "TWD",
-                        "wear_count": 0,
-                        "image_path": saved_img_path,
-                        "user_notes": item_info['notes'],
-                        "status": "available",
-                        "purchase_date": datetime.datetime.now().strftime("%Y-%m-%d"),
-                        "ai": ai_data
-                    }
-                    wardrobe_mgr.add_item(new_item)
-                    success_count += 1
-                except Exception as e:
-                    print(f"Save error: {e}")
-                    
+        # 複製圖片到 images/
+        try:
+            script_dir = os.path.dirname(os.path.abspath(__file__))
+            abs_image_dir = os.path.join(script_dir, IMAGE_DIR)
+            safe_id = "".join([c for c in new_id if c.isalnum() or c in ('-', '_')])
+            saved_img_path = store_image(final_img_path, abs_image_dir, safe_id)
+            
+            new_item = {
+                "id": new_id,
+                "name": item_info['name'],
+                "size": item_info['size'],
+                "price": 0,
+                "currency": "TWD",
+                "wear_count": 0,
+                "image_path": saved_img_path,
+                "user_notes": item_info['notes'],
+                "status": "available",
+                "purchase_date": datetime.datetime.now().strftime("%Y-%m-%d"),
+                "ai": ai_data
+            }
+            if img_path in duplicates:
+                new_item['user_notes'] += f" (可能與 {duplicates[img_path][0]} 重複)"
+            wardrobe_mgr.add_item(new_item)
+            IMAGE_HASH_INDEX.remember_source(new_id, src_hashes[i])
+            success_count += 1
+        except Exception as e:
+            print(f"Save error: {e}")
+            if report is not None:
+                report.append(f"{filename}: 存檔失敗 ({e})")
+    
+    IMAGE_HASH_INDEX.save()
     return success_count
 
 def build_batch_prompt(filenames: List[str], profile: Dict[str, Any]) -> str:
@@ -1245,9 +3571,137 @@ def build_batch_prompt(filenames: List[str], profile: Dict[str, Any]) -> str:
 """
     return prompt.strip()
 
-def process_offline_batch(json_text: str, folder_path: str, wardrobe_mgr: WardrobeManager) -> int:
+def chunk_for_batch(filenames: List[str], profile: Dict[str, Any], max_images: int = None,
+                    token_budget: int = None) -> List[List[int]]:
+    """
+    把待分析的圖片切成多組 (回傳每組的 index 清單)，每組不超過 max_images 張，
+    且 prompt + 圖片 + 預估輸出的 token 數不超過 token_budget。
+    """
+    max_images = max_images or AI_BATCH_MAX_IMAGES
+    token_budget = token_budget or AI_BATCH_TOKEN_BUDGET
+    base = estimate_tokens(build_batch_prompt([], profile))
+    chunks, current, used = [], [], base
+    for i, name in enumerate(filenames):
+        cost = GEMINI_IMAGE_TOKENS + AI_BATCH_OUTPUT_TOKENS_PER_ITEM + 2 * estimate_tokens(name)
+        if current and (len(current) >= max_images or used + cost > token_budget):
+            chunks.append(current)
+            current, used = [], base
+        current.append(i)
+        used += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+def parse_batch_response(raw_text: str, filenames: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    解析多圖分析的回應，依 filename 對回 filenames 中的檔名，回傳 {檔名: data}。
+    檔名大小寫或副檔名不同仍可對應；對不上、重複出現或 data 不完整的項目不列入 (由呼叫端改用單張分析)。
+    """
+    parsed = extract_json(raw_text) if raw_text else None
+    if isinstance(parsed, dict):
+        parsed = next((parsed[k] for k in ('items', 'data', 'list') if isinstance(parsed.get(k), list)), None)
+    if not isinstance(parsed, list):
+        return {}
+
+    exact = {f: f for f in filenames}
+    by_lower = {f.lower(): f for f in filenames}
+    by_stem = {}
+    for f in filenames:
+        by_stem.setdefault(os.path.splitext(f)[0].lower(), []).append(f)
+
+    mapped, conflicts = {}, set()
+    for entry in parsed:
+        if not isinstance(entry, dict):
+            continue
+        name, data = str(entry.get('filename') or '').strip(), entry.get('data')
+        if not isinstance(data, dict) or not data.get('type'):
+            continue
+        base = os.path.basename(name)
+        stems = by_stem.get(os.path.splitext(base)[0].lower(), [])
+        target = exact.get(name) or by_lower.get(base.lower()) or (stems[0] if len(stems) == 1 else None)
+        if not target:
+            print(f"Batch response has unknown filename: {name}")
+            continue
+        if target in mapped:
+            conflicts.add(target)
+        mapped[target] = data
+    for target in conflicts:
+        print(f"Batch response has duplicate entries for {target}")
+        del mapped[target]
+    return mapped
+
+def analyze_batched(image_paths: List[str], profile: Dict[str, Any], api_key: str, single_jobs: List[tuple],
+                    max_images: int = None, progress_callback=None, use_cache: bool = True,
+                    should_cancel=None) -> List[Dict[str, Any]]:
+    """
+    多張圖片 + 檔名打包成一個請求分析 (build_batch_prompt)，依 filename 對回結果。
+    回應中缺漏或對不上的項目，改用 single_jobs 中對應的單張分析 (prompt, image_path)。
+    回傳格式同 analyze_concurrently: [{'text': ..., 'error': ...}]，text 為 {"data": ...} JSON。
+    should_cancel() 回傳 True 時 (例如進度視窗被關閉)，還沒送出的請求都略過，也不做單張補分析。
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    total = len(image_paths)
+    max_images = max_images or AI_BATCH_MAX_IMAGES
+    if total == 0 or max_images <= 1:
+        return analyze_concurrently(single_jobs, api_key, progress_callback=progress_callback, use_cache=use_cache,
+                                    should_cancel=should_cancel)
+
+    filenames = [os.path.basename(p) for p in image_paths]
+    chunks = chunk_for_batch(filenames, profile, max_images=max_images)
+    results = [None] * total
+    limiter = TokenBucket(AI_REQUESTS_PER_MINUTE / 60.0, AI_MAX_IN_FLIGHT)
+    cancelled = False
+
+    def _run_chunk(indices):
+        if should_cancel and should_cancel():
+            raise AIRequestError('已取消')
+        names = [filenames[i] for i in indices]
+        images = [(f"檔名: {filenames[i]}", image_paths[i]) for i in indices]
+        return call_ai_with_retry(build_batch_prompt(names, profile), None, api_key, limiter,
+                                  use_cache=use_cache, images=images)
+
+    done = 0
+    with ThreadPoolExecutor(max_workers=max(1, min(AI_MAX_IN_FLIGHT, len(chunks)))) as pool:
+        futures = {pool.submit(_run_chunk, indices): indices for indices in chunks}
+        for future in as_completed(futures):
+            indices = futures[future]
+            try:
+                mapped = parse_batch_response(future.result(), [filenames[i] for i in indices])
+            except Exception as e:
+                print(f"Batch request failed ({len(indices)} images), falling back to single calls: {e}")
+                mapped = {}
+            for i in indices:
+                if filenames[i] in mapped:
+                    results[i] = {'text': json.dumps({'data': mapped[filenames[i]]}, ensure_ascii=False), 'error': None}
+            done += len(indices)
+            if (progress_callback and progress_callback(done, total, image_paths[indices[-1]]) is False) \
+                    or (should_cancel and should_cancel()):
+                cancelled = True
+                for f in futures:
+                    f.cancel()
+                break
+
+    missing = [i for i in range(total) if results[i] is None]
+    if cancelled:
+        print(f"Batched analysis cancelled: {total - len(missing)}/{total} images analyzed")
+        for i in missing:
+            results[i] = {'text': None, 'error': '已取消'}
+        return results
+    print(f"Batched analysis: {total} images in {len(chunks)} requests, {len(missing)} fell back to single calls")
+    if missing:
+        fallback = analyze_concurrently([single_jobs[i] for i in missing], api_key,
+                                        progress_callback=progress_callback, use_cache=use_cache,
+                                        should_cancel=should_cancel)
+        for i, result in zip(missing, fallback):
+            results[i] = result
+    return results
+
+def process_offline_batch(json_text: str, folder_path: str, wardrobe_mgr: WardrobeManager,
+                          report: Optional[List[str]] = None, progress_callback=None) -> int:
     """
     處理離線批次匯入的 JSON 回應。
+    report: 若有傳入，近似重複的照片 (略過或標示) 會逐行記錄在這裡
+    progress_callback: 建立衣櫃照片 hash 索引時的進度回呼 (見 build_known_hashes)
     """
     try:
         # 嘗試解析 JSON
@@ -1272,6 +3726,8 @@ def process_offline_batch(json_text: str, folder_path: str, wardrobe_mgr: Wardro
         success_count = 0
         script_dir = os.path.dirname(os.path.abspath(__file__))
         abs_image_dir = os.path.join(script_dir, IMAGE_DIR)
+        # 衣櫃照片的 hash 索引整批只建一次，之後逐張比對時把新照片加進去
+        known = build_known_hashes(wardrobe_mgr, progress_callback=progress_callback) if IMPORT_DUPLICATE_POLICY != 'off' else None
         
         for item in items_data:
             filename = item.get('filename')
@@ -1328,16 +3784,25 @@ def process_offline_batch(json_text: str, folder_path: str, wardrobe_mgr: Wardro
                 if not found:
                     print(f"File not found: {source_path} (and alternatives)")
                     continue
+            
+            # 近似重複檢查 (和衣櫃既有單品、以及這批已匯入的照片比對)
+            src_hash, duplicate = None, None
+            if IMPORT_DUPLICATE_POLICY != 'off':
+                hashes, dups = check_import_duplicates([source_path], wardrobe_mgr, known=known)
+                src_hash, duplicate = hashes[0], dups.get(source_path)
+                if duplicate:
+                    action = '略過' if IMPORT_DUPLICATE_POLICY == 'skip' else '標示'
+                    if report is not None:
+                        report.append(f"{filename} ≈ {duplicate[0]} (差 {duplicate[1]} bit，{action})")
+                    if IMPORT_DUPLICATE_POLICY == 'skip':
+                        continue
                 
             # 產生 ID 與存檔
             new_id = wardrobe_mgr.generate_id(ai_data.get('type', 'unknown'))
-            ext = os.path.splitext(filename)[1]
             safe_id = "".join([c for c in new_id if c.isalnum() or c in ('-', '_')])
-            saved_img_path = os.path.join(abs_image_dir, f"{safe_id}{ext}")
             
             try:
-                import shutil
-                shutil.copy2(source_path, saved_img_path)
+                saved_img_path = store_image(source_path, abs_image_dir, safe_id)
                 
                 new_item = {
                     "id": new_id,
@@ -1347,23 +3812,25 @@ def process_offline_batch(json_text: str, folder_path: str, wardrobe_mgr: Wardro
                     "currency": "TWD",
                     "wear_count": 0,
                     "image_path": saved_img_path,
-                    "user_notes": "Offline Batch Import",
+                    "user_notes": "Offline Batch Import" + (f" (可能與 {duplicate[0]} 重複)" if duplicate else ""),
                     "status": "available",
                     "purchase_date": datetime.datetime.now().strftime("%Y-%m-%d"),
                     "ai": ai_data
                 }
                 wardrobe_mgr.add_item(new_item)
+                IMAGE_HASH_INDEX.remember_source(new_id, src_hash)
                 success_count += 1
             except Exception as e:
                 print(f"Save error for {filename}: {e}")
-                
+        
+        IMAGE_HASH_INDEX.save()
         return success_count
         
     except Exception as e:
         print(f"Process offline batch error: {e}")
         return 0
 
-def main():
+def main(measure_startup: bool = False):
     # Register Custom Theme
     sg.LOOK_AND_FEEL_TABLE[THEME_NAME] = THEME_COLORS
     sg.theme(THEME_NAME)
@@ -1371,16 +3838,12 @@ def main():
     # 初始化 Managers
     profile_mgr = UserProfileManager(PROFILE_FILE)
     wardrobe_mgr = WardrobeManager(WARDROBE_FILE)
-    ootd_mgr = OOTDLogManager(OOTD_LOG_FILE)
-    currency_mgr = CurrencyManager()
+    ootd_mgr = OOTDLogManager(OOTD_LOG_FILE, legacy_path=LEGACY_OOTD_LOG_FILE)
+    currency_mgr = CurrencyManager(CURRENCY_CACHE_FILE)
     is_batch_mode = False # 批次管理模式狀態
-    
-    # 檢查匯率更新狀態
-    # 由於 CurrencyManager 在 init 時會自動 update_rates
-    # 我們可以檢查 rates 是否與預設值不同，或者簡單提示已嘗試更新
-    # 這裡假設 update_rates 會 print 訊息，我們在 GUI 上也顯示一下
-    # 為了更精確，我們可以修改 CurrencyManager 增加一個 last_updated 屬性，但這裡先簡單做
-    pass # 佔位，稍後在 window 建立後更新 status bar
+    calendar_limit = CALENDAR_PAGE_SIZE # 穿搭日曆目前顯示的筆數
+    calendar_logs = [] # 穿搭日曆目前顯示的紀錄 (新 -> 舊)
+    api_key = GEMINI_API_KEY # 本次執行輸入過的 Gemini API Key (單品分析、批次匯入、OOTD 共用)
     
     # 檢查是否需要初始化 Profile
     if not os.path.exists(PROFILE_FILE):
@@ -1409,6 +3872,7 @@ def main():
             [sg.Text('備註:', size=(8,1), font=FONT_NORMAL, background_color='#1E1E1E'), sg.Input(key='-ADD-NOTES-', font=FONT_NORMAL, background_color='#2C2C2C', text_color='white', border_width=0)],
             [sg.Push(background_color='#1E1E1E'), 
              sg.Button('✨ 產生分析 Prompt', key='-GEN-ADD-PROMPT-', font=FONT_HEADER, size=(20,1), button_color=('white', '#00897B'), border_width=0),
+             sg.Button('🤖 Gemini 直接分析', key='-AI-ADD-', font=FONT_HEADER, size=(18,1), button_color=('white', '#6A1B9A'), border_width=0, pad=((10,0), (0, 0)), visible=has_module('google.generativeai')),
              sg.Button('📂 批次匯入 (Batch)', key='-BATCH-MENU-', font=FONT_HEADER, button_color=('white', '#1565C0'), size=(20,1), pad=((10,0), (0, 0))),
              sg.Push(background_color='#1E1E1E')]
         ])],
@@ -1433,7 +3897,10 @@ def main():
             [sg.Text('天氣狀況:', size=(10,1), font=FONT_NORMAL, background_color='#1E1E1E'), sg.Input(key='-OOTD-WEATHER-', font=FONT_NORMAL, background_color='#2C2C2C', text_color='white', border_width=0)],
             [sg.Text('出席場合:', size=(10,1), font=FONT_NORMAL, background_color='#1E1E1E'), sg.Input(key='-OOTD-OCCASION-', font=FONT_NORMAL, background_color='#2C2C2C', text_color='white', border_width=0)],
             [sg.Text('心情/目標:', size=(10,1), font=FONT_NORMAL, background_color='#1E1E1E'), sg.Input(key='-OOTD-MOOD-', font=FONT_NORMAL, background_color='#2C2C2C', text_color='white', border_width=0)],
-            [sg.Push(background_color='#1E1E1E'), sg.Button('👗 產生 OOTD Prompt', key='-GEN-OOTD-PROMPT-', font=FONT_HEADER, size=(25,1), button_color=('white', '#E64A19'), border_width=0), sg.Push(background_color='#1E1E1E')]
+            [sg.Push(background_color='#1E1E1E'), sg.Button('👗 產生 OOTD Prompt', key='-GEN-OOTD-PROMPT-', font=FONT_HEADER, size=(25,1), button_color=('white', '#E64A19'), border_width=0),
+             sg.Button('🤖 Gemini 直接推薦', key='-AI-OOTD-', font=FONT_HEADER, size=(18,1), button_color=('white', '#6A1B9A'), border_width=0, visible=has_module('google.generativeai')),
+             sg.Button('🏠 本機推薦', key='-LOCAL-OOTD-', font=FONT_HEADER, size=(12,1), button_color=('white', '#424242'), border_width=0),
+             sg.Push(background_color='#1E1E1E')]
         ])],
         
         [sg.Text('步驟 1: 複製 Prompt', font=FONT_HEADER, text_color='#FFCC80', background_color=THEME_COLORS['BACKGROUND'], pad=((0,0), (20, 5)))],
@@ -1462,30 +3929,32 @@ def main():
     }
     
     header_list = ['選取', 'ID', '狀態', '分類', '名稱', '類型', '顏色']
+    # 表格資料在視窗出現後才由 -REFRESH-TABLE- 填入，避免大衣櫃拖慢開啟速度
     data_list = []
-    for item in wardrobe_mgr.items:
+    table_cols = WardrobeColumns([]) # 與 data_list 同一份快照的欄位資料
+    
+    # 用來追蹤目前表格顯示的資料 (因為會有篩選)
+    current_table_data = data_list
+    dupes_thread = None # 背景檢查重複單品的執行緒
+
+    def table_row(item):
         status_key = item.get('status', 'available')
         status_text = STATUS_MAP.get(status_key, status_key)
         item_type = item.get('ai', {}).get('type', '')
-        category = get_category(item_type)
-        
-        data_list.append([
-            '☐', # 0: Checkbox
+        return [
+            '☐' if is_batch_mode else '', # Checkbox only if batch mode
             item['id'], 
             status_text,
-            category,
+            get_category(item_type),
             item['name'], 
             item_type,
             item.get('ai', {}).get('color', '')
-        ])
-    
-    # 用來追蹤目前表格顯示的資料 (因為會有篩選)
-    current_table_data = data_list
+        ]
 
     tab3_layout = [
         [card_frame(' 🔍 篩選條件 ', [
             [sg.Text('關鍵字:', font=FONT_NORMAL, background_color='#1E1E1E'), sg.Input(key='-FILTER-TXT-', size=(15,1), font=FONT_NORMAL, background_color='#2C2C2C', text_color='white', border_width=0),
-             sg.Text('分類:', font=FONT_NORMAL, background_color='#1E1E1E'), sg.Combo(get_unique_categories(wardrobe_mgr.items), default_value='全部', key='-FILTER-CAT-', font=FONT_NORMAL, readonly=True, background_color='#2C2C2C', text_color='white'),
+             sg.Text('分類:', font=FONT_NORMAL, background_color='#1E1E1E'), sg.Combo(['全部'], default_value='全部', key='-FILTER-CAT-', font=FONT_NORMAL, readonly=True, background_color='#2C2C2C', text_color='white'),
              sg.Button('🔍 搜尋', key='-APPLY-FILTER-', font=FONT_NORMAL, button_color=('white', '#00897B'), border_width=0),
              sg.Button('❌ 清除', key='-CLEAR-FILTER-', font=FONT_NORMAL, button_color=('white', '#424242'), border_width=0)]
         ])],
@@ -1553,7 +4022,8 @@ def main():
                   background_color='#1E1E1E', text_color='#E0E0E0', 
                   header_background_color='#2C2C2C', header_text_color='#D4AF37',
                   alternating_row_color='#121212')],
-        [sg.Button('🔄 重新整理', key='-REFRESH-CALENDAR-', font=FONT_NORMAL, button_color=('white', '#424242'), border_width=0)]
+        [sg.Button('🔄 重新整理', key='-REFRESH-CALENDAR-', font=FONT_NORMAL, button_color=('white', '#424242'), border_width=0),
+         sg.Button('⬇️ 載入更早紀錄', key='-CALENDAR-MORE-', font=FONT_NORMAL, button_color=('white', '#424242'), border_width=0, visible=False)]
     ]
 
     # 主視窗 Layout
@@ -1580,7 +4050,24 @@ def main():
     window['-WARDROBE-TABLE-'].bind('<Double-Button-1>', '+DOUBLE_CLICK+')
     window['-CALENDAR-TABLE-'].bind('<Double-Button-1>', '+DOUBLE_CLICK+')
 
+    if measure_startup:
+        first_window_time = time.perf_counter() - _PROCESS_START
+        print(f"Time to first window: {first_window_time:.3f}s")
+        for name, secs in IMPORT_TIMINGS.items():
+            print(f"  import {name}: {secs:.3f}s")
+        window['-STATUS-'].update(f'啟動時間: {first_window_time:.2f} 秒')
+
+    # 匯率: 先用快取，過期才在背景更新 (完成後觸發 -RATES-UPDATED-)
+    currency_mgr.start_background_refresh(window)
+
+    # 背景預熱: 使用者可能很快就會用到縮圖與去背
+    if WARM_UP_IMPORTS:
+        warm_up_imports(['PIL.Image'])
+        if HAS_REMBG:
+            REMBG_SESSION_MANAGER.preload('u2net') # 連同 rembg 模組一起載入
+
     # Startup Refresh
+    window.write_event_value('-REFRESH-TABLE-', None)
     window.write_event_value('-REFRESH-CALENDAR-', None)
 
     while True:
@@ -1644,6 +4131,39 @@ def main():
             window['-STATUS-'].update('Prompt 已產生，請複製給 GPT。')
 
 
+        if event == '-AI-ADD-':
+            item_info = {
+                'name': values['-ADD-NAME-'],
+                'size': values['-ADD-SIZE-'],
+                'notes': values['-ADD-NOTES-']
+            }
+            img_path = values['-ADD-IMG-PATH-']
+            if not img_path:
+                sg.popup_error('請先上傳圖片！\n為了讓 AI 能準確分析，請務必提供衣服的照片。')
+                continue
+            api_key = api_key or sg.popup_get_text('請輸入 Gemini API Key:', password_char='*')
+            if not api_key:
+                continue
+            prompt = build_add_item_prompt(profile_mgr.data, item_info)
+            window['-ADD-PROMPT-OUT-'].update(prompt)
+            window['-ADD-GPT-RESPONSE-'].update('')
+            window['-STATUS-'].update('Gemini 分析中...')
+            start_ai_request(window, '-AI-ADD-DONE-', prompt, img_path, api_key)
+
+        if event in ('-AI-ADD-DONE-', '-AI-OOTD-DONE-'):
+            text, error, elapsed_ms = values[event]
+            if error:
+                window['-STATUS-'].update('Gemini 呼叫失敗')
+                if event == '-AI-OOTD-DONE-':
+                    if sg.popup_yes_no(f'Gemini 呼叫失敗: {error}\n\n要改用本機推薦嗎？') == 'Yes':
+                        window.write_event_value('-LOCAL-OOTD-', None)
+                else:
+                    sg.popup_error(f'Gemini 呼叫失敗: {error}')
+                continue
+            target = '-ADD-GPT-RESPONSE-' if event == '-AI-ADD-DONE-' else '-OOTD-RESPONSE-'
+            window[target].update(text)
+            window['-STATUS-'].update(f'Gemini 回應完成 ({elapsed_ms:.0f} ms)，請按「解析」確認。')
+
         if event == '-COPY-PROMPT-':
             sg.clipboard_set(values['-ADD-PROMPT-OUT-'])
             window['-STATUS-'].update('Prompt 已複製到剪貼簿！')
@@ -1698,18 +4218,11 @@ def main():
                         if not os.path.exists(abs_image_dir):
                             os.makedirs(abs_image_dir)
                             
-                        # 產生新檔名: id.png (保留原副檔名)
-                        ext = os.path.splitext(source_img_path)[1]
-                        if not ext: ext = '.png'
-                        
                         # 移除檔名中的非法字元 (例如 / \ : * ? " < > |)
                         safe_id = "".join([c for c in new_id if c.isalnum() or c in ('-', '_')])
-                        new_filename = f"{safe_id}{ext}"
-                        final_img_path = os.path.join(abs_image_dir, new_filename)
                         
-                        # 複製檔案 (使用 shutil 或讀寫)
-                        import shutil
-                        shutil.copy2(source_img_path, final_img_path)
+                        # 存成縮小的 WebP: id.webp (沒有 Pillow 時保留原副檔名)
+                        final_img_path = store_image(source_img_path, abs_image_dir, safe_id)
                         print(f"Image saved to: {final_img_path}")
                     except Exception as e:
                         sg.popup_error(f"圖片儲存失敗: {e}")
@@ -1759,7 +4272,7 @@ def main():
                 item_id = row_data[1] # ID is now at index 1
                 
                 # 找出原始 item
-                target_item = next((x for x in wardrobe_mgr.items if x['id'] == item_id), None)
+                target_item = wardrobe_mgr.get(item_id)
                 if target_item:
                     ai_data = target_item.get('ai', {})
                     
@@ -1893,20 +4406,18 @@ def main():
             # 反向對照找出 key
             target_status = next((k for k, v in STATUS_MAP.items() if v == target_status_display), 'available')
             
-            count = 0
-            for row in current_table_data:
-                if row[0] == '☑':
-                    item_id = row[1] # ID 在第二欄 (index 1)
-                    wardrobe_mgr.update_item(item_id, {'status': target_status})
-                    count += 1
-            
+            # ID 在第二欄 (index 1)
+            checked_ids = [row[1] for row in current_table_data if row[0] == '☑']
+            if not checked_ids:
+                sg.popup_error('請先勾選要修改的衣服！')
+                continue
+
+            count = wardrobe_mgr.bulk_update(checked_ids, {'status': target_status})
             if count > 0:
                 sg.popup(f'已將 {count} 件衣服狀態更新為 {target_status_display}！')
                 # 執行完後是否要退出批次模式？看使用者習慣，這裡先保留
                 window.write_event_value('-REFRESH-TABLE-', None)
                 window.write_event_value('-REFRESH-ANALYTICS-', None)
-            else:
-                sg.popup_error('請先勾選要修改的衣服！')
 
         # --- 表格點擊事件 (處理 Checkbox) ---
         if isinstance(event, tuple) and event[0] == '-WARDROBE-TABLE-':
@@ -1935,6 +4446,8 @@ def main():
                 [sg.HorizontalSeparator()],
                 [sg.Button('📋 手動匯入 (ChatGPT Mode)', key='-MODE-GPT-', size=(30, 2), font=FONT_HEADER, button_color=('white', '#E64A19'))],
                 [sg.Text('   免 API Key，需手動複製 Prompt 與貼上 JSON', font=FONT_SMALL, text_color='#FFCC80')],
+                [sg.HorizontalSeparator()],
+                [sg.Button('🔍 檢查衣櫃重複單品', key='-MODE-DUPES-', size=(30, 1), font=FONT_NORMAL, button_color=('white', '#424242'))],
                 [sg.Button('取消', key='-CANCEL-MODE-', size=(10,1), pad=((0,0), (20,0)))]
             ]
             mode_win = sg.Window('批次匯入模式選擇', mode_layout, modal=True, element_justification='center')
@@ -1944,7 +4457,7 @@ def main():
                 # === API Mode Logic ===
                 folder_path = sg.popup_get_folder('請選擇要匯入的照片資料夾')
                 if folder_path:
-                    api_key = sg.popup_get_text('請輸入 OpenAI API Key (若無則使用模擬模式):', password_char='*')
+                    api_key = sg.popup_get_text('請輸入 Gemini API Key:', default_text=api_key or '', password_char='*') or api_key
                     
                     prog_layout = [
                         [sg.Text('正在批次處理中...', font=FONT_HEADER)],
@@ -1955,9 +4468,16 @@ def main():
                     prog_win = sg.Window('批次匯入進度', prog_layout, modal=True, finalize=True)
                     
                     try:
-                        count = process_batch_import(folder_path, wardrobe_mgr, profile_mgr, prog_win, api_key)
+                        dup_report = []
+                        count = process_batch_import(folder_path, wardrobe_mgr, profile_mgr, prog_win, api_key, report=dup_report)
                         prog_win.close()
-                        sg.popup(f'批次匯入完成！\n成功匯入 {count} 件衣服。')
+                        msg = f'批次匯入完成！\n成功匯入 {count} 件衣服。'
+                        if dup_report:
+                            msg += f'\n\n未匯入或需要確認的項目 ({len(dup_report)})：\n' + '\n'.join(dup_report)
+                        timing = gemini_timing_report(api_key)
+                        if timing:
+                            msg += f'\n\n{timing}'
+                        sg.popup(msg)
                         window.write_event_value('-REFRESH-TABLE-', None)
                         window.write_event_value('-REFRESH-ANALYTICS-', None)
                     except Exception as e:
@@ -1968,19 +4488,28 @@ def main():
                 # === GPT Mode Logic ===
                 folder_path = sg.popup_get_folder('請選擇要處理的照片資料夾')
                 if folder_path:
-                    # 1. 預處理
-                    sg.popup_quick_message('正在準備圖片與去背中...', background_color='#1E1E1E', text_color='#D4AF37')
+                    # 1. 預處理 (平行去背)
                     valid_exts = ('.jpg', '.jpeg', '.png')
                     files = [f for f in os.listdir(folder_path) if f.lower().endswith(valid_exts) and '_nobg' not in f]
+                    dup_report = []
+                    prog_layout = [
+                        [sg.Text('正在準備圖片與去背中...', font=FONT_HEADER)],
+                        [sg.Text('準備開始...', key='-PROG-TXT-', size=(50,1))],
+                        [sg.ProgressBar(100, orientation='h', size=(50, 20), key='-PROG-BAR-')]
+                    ]
+                    prog_win = sg.Window('去背進度', prog_layout, modal=True, finalize=True)
+                    if IMPORT_DUPLICATE_POLICY == 'skip':
+                        # 已在衣櫃中的照片不必再去背、也不必放進 Prompt
+                        _, duplicates = check_import_duplicates([os.path.join(folder_path, f) for f in files], wardrobe_mgr,
+                                                                progress_callback=make_progress_callback(prog_win, '正在比對重複照片'))
+                        dup_report = [f"{os.path.basename(p)} ≈ {owner} (差 {d} bit，略過)" for p, (owner, d) in duplicates.items()]
+                        files = [f for f in files if os.path.join(folder_path, f) not in duplicates]
                     
-                    processed_files = []
-                    for f in files:
-                        img_path = os.path.join(folder_path, f)
-                        nobg_path = remove_bg_silent(img_path)
-                        if nobg_path:
-                            processed_files.append(os.path.basename(nobg_path))
-                        else:
-                            processed_files.append(f)
+                    nobg_paths = remove_bg_batch([os.path.join(folder_path, f) for f in files],
+                                                 progress_callback=make_progress_callback(prog_win, '正在去背'))
+                    prog_win.close()
+                    
+                    processed_files = [os.path.basename(nobg) if nobg else f for f, nobg in zip(files, nobg_paths)]
                     
                     if not processed_files:
                         sg.popup_error('資料夾內沒有圖片！')
@@ -2019,9 +4548,18 @@ def main():
                                     sg.popup_error('請先貼上 JSON！')
                                     continue
                                     
-                                count = process_offline_batch(json_text, folder_path, wardrobe_mgr)
+                                prog_win = sg.Window('匯入進度', [
+                                    [sg.Text('準備開始...', key='-PROG-TXT-', size=(50,1))],
+                                    [sg.ProgressBar(100, orientation='h', size=(50, 20), key='-PROG-BAR-')]
+                                ], modal=True, finalize=True)
+                                count = process_offline_batch(json_text, folder_path, wardrobe_mgr, report=dup_report,
+                                                              progress_callback=make_progress_callback(prog_win, '正在比對重複照片'))
+                                prog_win.close()
                                 if count > 0:
-                                    sg.popup(f'成功匯入 {count} 件衣服！')
+                                    msg = f'成功匯入 {count} 件衣服！'
+                                    if dup_report:
+                                        msg += f'\n\n近似重複的照片 ({len(dup_report)})：\n' + '\n'.join(dup_report)
+                                    sg.popup(msg)
                                     window.write_event_value('-REFRESH-TABLE-', None)
                                     window.write_event_value('-REFRESH-ANALYTICS-', None)
                                     break
@@ -2030,6 +4568,36 @@ def main():
                         
                         batch_win.close()
 
+            elif mode_event == '-MODE-DUPES-':
+                # 第一次要解碼所有衣櫃照片，放到背景執行緒做，完成後送出 -DUPES-DONE-
+                if dupes_thread and dupes_thread.is_alive():
+                    sg.popup_quick_message('仍在檢查重複單品中...')
+                else:
+                    def _find_dupes():
+                        def _progress(done, total, _label):
+                            window.write_event_value('-DUPES-PROGRESS-', (done, total))
+                        try:
+                            groups = find_duplicate_items(wardrobe_mgr, progress_callback=_progress)
+                        except Exception as e:
+                            print(f"Find duplicates failed: {e}")
+                            groups = None
+                        window.write_event_value('-DUPES-DONE-', groups)
+                    window['-STATUS-'].update('正在檢查重複單品...')
+                    dupes_thread = threading.Thread(target=_find_dupes, daemon=True)
+                    dupes_thread.start()
+
+        if event == '-DUPES-PROGRESS-':
+            done, total = values[event]
+            window['-STATUS-'].update(f'正在檢查重複單品 ({done}/{total})...')
+
+        if event == '-DUPES-DONE-':
+            groups = values[event]
+            if groups is None:
+                window['-STATUS-'].update('檢查重複單品失敗')
+            else:
+                window['-STATUS-'].update(f'重複單品檢查完成 ({len(groups)} 組)')
+                sg.popup_scrolled(format_duplicate_report(wardrobe_mgr, groups), title='重複單品', size=(60, 20))
+
         # --- 刪除單品 (支援單選與批次) ---
         if event == '-DELETE-ITEM-':
             # 1. 檢查是否為批次模式且有勾選項目
@@ -2067,10 +4635,7 @@ def main():
             confirm_msg += "\n\n此動作無法復原！"
             
             if sg.popup_yes_no(confirm_msg, title='確認刪除', icon='warning') == 'Yes':
-                success_count = 0
-                for item_id in ids_to_delete:
-                    if wardrobe_mgr.delete_item(item_id):
-                        success_count += 1
+                success_count = wardrobe_mgr.bulk_delete(ids_to_delete)
                 
                 if len(ids_to_delete) > 1:
                     sg.popup(f'已成功刪除 {success_count} 件衣服。')
@@ -2081,25 +4646,27 @@ def main():
                 window.write_event_value('-REFRESH-TABLE-', None)
                 window.write_event_value('-REFRESH-ANALYTICS-', None)
 
+        # --- 篩選 ---
+        if event == '-APPLY-FILTER-':
+            keyword = values['-FILTER-TXT-'].strip().lower()
+            category = values['-FILTER-CAT-']
+            # table_cols 與 data_list 在 -REFRESH-TABLE- 由同一份快照建立，列索引一定對得上
+            rows = table_cols.filter(category=None if category in ('', '全部') else category)
+            current_table_data = [data_list[i] for i in rows]
+            if keyword:
+                current_table_data = [row for row in current_table_data
+                                      if any(keyword in str(row[c]).lower() for c in (1, 4, 5, 6))]
+            window['-WARDROBE-TABLE-'].update(values=current_table_data)
+            window['-WARDROBE-COUNT-'].update(f'篩選結果 {len(current_table_data)} / {len(wardrobe_mgr.items)} 件衣服')
+
+        if event == '-CLEAR-FILTER-':
+            window.write_event_value('-REFRESH-TABLE-', None)
+
         # --- 重新整理列表 ---
         if event == '-REFRESH-TABLE-':
-            # 重建 data_list
-            data_list = []
-            for item in wardrobe_mgr.items:
-                status_key = item.get('status', 'available')
-                status_text = STATUS_MAP.get(status_key, status_key)
-                item_type = item.get('ai', {}).get('type', '')
-                category = get_category(item_type)
-                
-                data_list.append([
-                    '☐' if is_batch_mode else '', # Checkbox only if batch mode
-                    item['id'], 
-                    status_text,
-                    category,
-                    item['name'], 
-                    item_type,
-                    item.get('ai', {}).get('color', '')
-                ])
+            # 重建 data_list (列順序與 table_cols 相同，篩選時直接用列索引)
+            table_cols = wardrobe_mgr.columns()
+            data_list = [table_row(wardrobe_mgr.get(item_id)) for item_id in table_cols.ids]
             
             # 更新 Table
             window['-WARDROBE-TABLE-'].update(values=data_list)
@@ -2136,10 +4703,48 @@ def main():
                 "mood": mood if mood else "不限 (自由發揮)"
             }
             
-            prompt = build_ootd_prompt(profile_mgr.data, wardrobe_mgr.items, context)
+            prompt_stats = {}
+            shortlist = suggest_outfits(wardrobe_mgr.items, context) if OOTD_SHORTLIST_IN_PROMPT else None
+            prompt = build_ootd_prompt(profile_mgr.data, wardrobe_mgr.items, context, stats=prompt_stats, shortlist=shortlist)
             window['-OOTD-PROMPT-OUT-'].update(prompt)
             window['-OOTD-RESPONSE-'].update('') # 清空舊的回應
-            window['-STATUS-'].update('OOTD Prompt 已產生，請複製給 GPT。')
+            window['-STATUS-'].update(f"OOTD Prompt 已產生，請複製給 GPT。(候選 {prompt_stats['items_after']}/{prompt_stats['items_before']} 件，"
+                                      f"約 {prompt_stats['tokens_after']} tokens，原本約 {prompt_stats['tokens_before']})")
+
+        if event == '-AI-OOTD-':
+            context = {
+                "weather": values['-OOTD-WEATHER-'] or "不限 (自由發揮)",
+                "occasion": values['-OOTD-OCCASION-'] or "不限 (自由發揮)",
+                "mood": values['-OOTD-MOOD-'] or "不限 (自由發揮)"
+            }
+            api_key = api_key or sg.popup_get_text('請輸入 Gemini API Key:', password_char='*')
+            if not api_key:
+                continue
+            prompt_stats = {}
+            shortlist = suggest_outfits(wardrobe_mgr.items, context) if OOTD_SHORTLIST_IN_PROMPT else None
+            prompt = build_ootd_prompt(profile_mgr.data, wardrobe_mgr.items, context, stats=prompt_stats, shortlist=shortlist)
+            window['-OOTD-PROMPT-OUT-'].update(prompt)
+            window['-OOTD-RESPONSE-'].update('')
+            window['-STATUS-'].update(f"Gemini 搭配中... (候選 {prompt_stats['items_after']}/{prompt_stats['items_before']} 件，約 {prompt_stats['tokens_after']} tokens)")
+            # 穿搭推薦按一次就該重新搭配，不回傳快取裡上次的結果
+            start_ai_request(window, '-AI-OOTD-DONE-', prompt, None, api_key, use_cache=False)
+
+        if event == '-LOCAL-OOTD-':
+            # 不經 AI，直接以本機評分推薦；結果填入回應欄後走一般的解析/記錄流程
+            context = {
+                "weather": values['-OOTD-WEATHER-'] or "",
+                "occasion": values['-OOTD-OCCASION-'] or "",
+                "mood": values['-OOTD-MOOD-'] or ""
+            }
+            t0 = time.perf_counter()
+            outfits = suggest_outfits(wardrobe_mgr.items, context)
+            elapsed_ms = (time.perf_counter() - t0) * 1000
+            if not outfits:
+                sg.popup_error('衣櫃中的單品不足以組成一套穿搭 (需要上身+下身或洋裝)。')
+                continue
+            window['-OOTD-RESPONSE-'].update(json.dumps({"ok": True, "message": "本機推薦", "outfits": outfits}, ensure_ascii=False, indent=2))
+            window['-STATUS-'].update(f'本機推薦完成 ({elapsed_ms:.0f} ms)')
+            window.write_event_value('-PARSE-OOTD-', None)
 
         if event == '-COPY-OOTD-':
             sg.clipboard_set(values['-OOTD-PROMPT-OUT-'])
@@ -2168,7 +4773,7 @@ def main():
                     "item_ids": outfit.get('itemIds', []),
                     "notes": outfit.get('notes', '')
                 }
-                ootd_mgr.add_log(log_entry)
+                is_new_log = ootd_mgr.add_log(log_entry)
                 
                 # 顯示
                 # msg = f"✨ 推薦穿搭: {outfit.get('title')}\n\n"
@@ -2180,39 +4785,40 @@ def main():
                 # show_ootd_result_window(outfit, wardrobe_mgr)
                 show_ootd_result_window(outfit, wardrobe_mgr, profile_mgr)
                 
-                window['-STATUS-'].update('OOTD 解析成功並已記錄！')
+                window['-STATUS-'].update('OOTD 解析成功並已記錄！' if is_new_log else 'OOTD 解析成功 (相同穿搭剛記錄過，未重複記錄)')
                 window.write_event_value('-REFRESH-CALENDAR-', None)
 
 
 
+        # --- 匯率背景更新完成 ---
+        if event == '-RATES-UPDATED-':
+            window['-STATUS-'].update(f"匯率已更新 ({currency_mgr.last_updated.strftime('%Y-%m-%d %H:%M')})")
+            window.write_event_value('-REFRESH-ANALYTICS-', None)
+
         # --- 數據分析更新 ---
         if event == '-REFRESH-ANALYTICS-' or event == '-BASE-CURRENCY-':
             base_curr = values.get('-BASE-CURRENCY-', 'TWD')
-            total_value = 0
-            total_count = len(wardrobe_mgr.items)
-            cp_list = []
-            
-            for item in wardrobe_mgr.items:
-                price = item.get('price', 0)
-                currency = item.get('currency', 'TWD')
-                wear_count = item.get('wear_count', 0)
-                
-                # 統一轉換為 Base Currency 計算
-                price_in_base = currency_mgr.convert(price, currency, base_curr)
-                
-                total_value += price_in_base
-                
-                # 計算 CP 值 (每次成本)
-                # 如果沒穿過，成本 = 原價
-                cost_per_wear = price_in_base if wear_count == 0 else price_in_base / wear_count
-                
-                cp_list.append({
-                    'name': item['name'],
-                    'price_display': f"{currency} {price}",
-                    'price_base': price_in_base,
-                    'wear_count': wear_count,
-                    'cp': cost_per_wear
-                })
+            cols = wardrobe_mgr.columns()
+            total_count = len(cols)
+            
+            # 每種幣別只查一次匯率 (convert 是線性的，換算係數 = convert(1, ...))
+            factors = [currency_mgr.convert(1.0, c, base_curr) for c in cols.currency_names]
+            price_in_base = [p * factors[c] for p, c in zip(cols.price, cols.currency)]
+            total_value = sum(price_in_base)
+            
+            # 計算 CP 值 (每次成本)
+            # 如果沒穿過，成本 = 原價
+            cost_per_wear = [p if w == 0 else p / w for p, w in zip(price_in_base, cols.wear_count)]
+            
+            import heapq
+            top_rows = heapq.nsmallest(10, range(total_count), key=cost_per_wear.__getitem__)
+            cp_list = [{
+                'name': cols.names[i],
+                'price_display': f"{cols.currency_names[cols.currency[i]]} {wardrobe_mgr.items[i].get('price', 0)}",
+                'price_base': price_in_base[i],
+                'wear_count': cols.wear_count[i],
+                'cp': cost_per_wear[i]
+            } for i in top_rows]
             
             avg_price = total_value / total_count if total_count > 0 else 0
             
@@ -2221,23 +4827,22 @@ def main():
             window['-AVG-PRICE-'].update(f'{base_curr} {int(avg_price):,}')
             window['-TOTAL-COUNT-'].update(str(total_count))
             
-            # 更新 CP 值排行
-            cp_list.sort(key=lambda x: x['cp'])
-            
+            # 更新 CP 值排行 (cp_list 已排序)
             table_data = [[x['name'], x['price_display'], x['wear_count'], f"{base_curr} {int(x['cp'])}"] for x in cp_list[:10]]
             window['-CP-TABLE-'].update(values=table_data)
 
         # --- 穿搭日曆更新 ---
+        if event == '-CALENDAR-MORE-':
+            calendar_limit += CALENDAR_PAGE_SIZE
+            window.write_event_value('-REFRESH-CALENDAR-', None)
+
         if event == '-REFRESH-CALENDAR-':
             calendar_data = []
-            # 反向排序，最新的在上面
-            for log in reversed(ootd_mgr.logs):
+            # 只讀最近 calendar_limit 筆，反向排序，最新的在上面
+            calendar_logs = list(reversed(ootd_mgr.tail(calendar_limit)))
+            for log in calendar_logs:
                 # 組合單品名稱
-                item_names = []
-                for iid in log.get('item_ids', []):
-                    found = next((x for x in wardrobe_mgr.items if x['id'] == iid), None)
-                    if found:
-                        item_names.append(found['name'])
+                item_names = [x['name'] for x in wardrobe_mgr.get_many(log.get('item_ids', []))]
                 
                 calendar_data.append([
                     log.get('date', ''),
@@ -2245,6 +4850,7 @@ def main():
                     ", ".join(item_names)
                 ])
             window['-CALENDAR-TABLE-'].update(values=calendar_data)
+            window['-CALENDAR-MORE-'].update(visible=len(calendar_logs) < ootd_mgr.count)
 
         # --- 查看日曆詳情 ---
         if event == '-CALENDAR-TABLE-+DOUBLE_CLICK+':
@@ -2252,14 +4858,9 @@ def main():
                 continue
             
             row_idx = values['-CALENDAR-TABLE-'][0]
-            # calendar_data 是反向排序的，所以要對應回 logs
-            # logs: [old, ..., new]
-            # calendar: [new, ..., old]
-            # log_idx = len(logs) - 1 - row_idx
-            
-            if row_idx < len(ootd_mgr.logs):
-                log_idx = len(ootd_mgr.logs) - 1 - row_idx
-                log = ootd_mgr.logs[log_idx]
+            # calendar_logs 與表格列的順序相同 (新 -> 舊)
+            if row_idx < len(calendar_logs):
+                log = calendar_logs[row_idx]
                 
                 # 重建 outfit 物件
                 outfit = {
@@ -2297,7 +4898,7 @@ def main():
                 row_data = current_table_data[row_idx]
                 item_id = row_data[1] # ID 在第二欄 (index 1)
                 
-                target_item = next((x for x in wardrobe_mgr.items if x['id'] == item_id), None)
+                target_item = wardrobe_mgr.get(item_id)
                 if target_item:
                     # 顯示詳情視窗
                     ai_data = target_item.get('ai', {})
@@ -2305,14 +4906,9 @@ def main():
                     # 圖片處理
                     img_elem = sg.Image(data=None, size=(300, 300), background_color='#1E1E1E')
                     if HAS_PIL and target_item.get('image_path') and os.path.exists(target_item['image_path']):
-                        try:
-                            pil_img = Image.open(target_item['image_path'])
-                            pil_img.thumbnail((300, 300))
-                            bio = io.BytesIO()
-                            pil_img.save(bio, format="PNG")
-                            img_elem = sg.Image(data=bio.getvalue(), background_color='#1E1E1E', enable_events=True, key='-VIEW-IMG-', tooltip='點擊放大')
-                        except:
-                            pass
+                        thumb_bytes = resize_image_to_bytes(target_item['image_path'], (300, 300))
+                        if thumb_bytes:
+                            img_elem = sg.Image(data=thumb_bytes, background_color='#1E1E1E', enable_events=True, key='-VIEW-IMG-', tooltip='點擊放大')
 
                     detail_layout = [
                         [sg.Text(target_item.get('name', '未命名'), font=('Segoe UI', 18, 'bold'), text_color='#D4AF37', background_color='#1E1E1E')],
@@ -2376,4 +4972,23 @@ def main():
     window.close()
 
 if __name__ == '__main__':
-    main()
+    # python wardrobe_app.py --startup-time        顯示視窗出現所需時間
+    # python wardrobe_app.py --prewarm-thumbnails  預先產生 images/ 的縮圖快取
+    # python wardrobe_app.py --benchmark-rembg [dir] 比較去背快速模式與原流程的速度/邊緣品質
+    # python wardrobe_app.py --find-duplicates     列出衣櫃中照片近似重複的單品
+    # python wardrobe_app.py --migrate-images      把 images/ 既有圖片轉成縮小的 WebP
+    if '--prewarm-thumbnails' in sys.argv:
+        print(f"Generated {prewarm_thumbnails()} thumbnails in {THUMB_CACHE_DIR}")
+    elif '--migrate-images' in sys.argv:
+        mgr = WardrobeManager(WARDROBE_FILE)
+        stats = migrate_image_store(mgr, progress_callback=lambda done, total, path: print(f"[{done}/{total}] {path}"))
+        print(f"Converted {stats['converted']} images ({stats['failed']} failed): "
+              f"{stats['bytes_before'] / 1048576:.1f} MB -> {stats['bytes_after'] / 1048576:.1f} MB")
+    elif '--find-duplicates' in sys.argv:
+        mgr = WardrobeManager(WARDROBE_FILE)
+        print(format_duplicate_report(mgr, find_duplicate_items(mgr)))
+    elif '--benchmark-rembg' in sys.argv:
+        args = sys.argv[sys.argv.index('--benchmark-rembg') + 1:]
+        benchmark_rembg(args[0] if args and not args[0].startswith('--') else IMAGE_DIR)
+    else:
+        main(measure_startup='--startup-time' in sys.argv)